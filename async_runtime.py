@@ -0,0 +1,208 @@
+import asyncio
+import json
+import logging
+import threading
+
+import aiohttp
+from pymongo import AsyncMongoClient
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+from premium import GrantService
+from reconciler import CryptoCloudReconciler
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncRuntime:
+    """One asyncio event loop on a background thread for I/O-bound handlers.
+
+    Update workers hand coroutines over with ``submit`` and go back to the
+    queue straight away, so a handler waiting on a payment provider or MongoDB
+    costs a coroutine on this loop instead of a worker thread. At most
+    ``max_tasks`` coroutines run at once; the rest wait on the loop.
+    Coroutines submitted with the same ``key`` (a chat id) run one after
+    another in submission order, like updates on one ShardedExecutor shard.
+    """
+
+    def __init__(self, max_tasks=1000, name='asyncio-runtime'):
+        self.loop = asyncio.new_event_loop()
+        self.max_tasks = max_tasks
+        self.stats = {'submitted': 0, 'in_flight': 0, 'errors': 0}
+        self._lock = threading.Lock()
+        self._limit = None
+        # key -> future that resolves when the last coroutine submitted for it is done
+        self._tails = {}
+        self._closers = []
+        self._thread = threading.Thread(target=self._run_loop, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, coro, key=None):
+        # Schedule a coroutine from any thread, returns a concurrent.futures.Future
+        with self._lock:
+            self.stats['submitted'] += 1
+            self.stats['in_flight'] += 1
+        future = asyncio.run_coroutine_threadsafe(self._limited(coro, key), self.loop)
+        future.add_done_callback(self._finished)
+        return future
+
+    def run(self, coro, timeout=None):
+        # Run a coroutine to completion from a thread other than the loop's
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def handler(self, coroutine_function, key=None):
+        # Wrap ``async def handler(call)`` into a plain callable for telebot/CallbackRouter.
+        # ``key(call)`` picks the ordering key, usually the chat id.
+        def submit_handler(*args, **kwargs):
+            self.submit(coroutine_function(*args, **kwargs), key(*args, **kwargs) if key else None)
+        submit_handler.__name__ = coroutine_function.__name__
+        return submit_handler
+
+    def on_stop(self, close):
+        # ``close`` is a coroutine function run on the loop by ``stop``
+        self._closers.append(close)
+
+    def stop(self, timeout=5):
+        if not self._thread.is_alive():
+            return
+        for close in self._closers:
+            try:
+                self.run(close(), timeout=timeout)
+            except Exception as e:
+                logger.error(f"Error closing async client: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+
+    async def _limited(self, coro, key):
+        # Runs on the loop thread, so _tails needs no lock. Tasks start in submission
+        # order, so each one finds its predecessor for the key in _tails.
+        if self._limit is None:
+            self._limit = asyncio.Semaphore(self.max_tasks)
+        previous = self._tails.get(key) if key is not None else None
+        done = self.loop.create_future()
+        if key is not None:
+            self._tails[key] = done
+        try:
+            if previous is not None:
+                await previous
+            async with self._limit:
+                return await coro
+        finally:
+            done.set_result(None)
+            if key is not None and self._tails.get(key) is done:
+                del self._tails[key]
+
+    def _finished(self, future):
+        with self._lock:
+            self.stats['in_flight'] -= 1
+            if not future.cancelled() and future.exception() is not None:
+                self.stats['errors'] += 1
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Error in async handler: {future.exception()}")
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+
+class AsyncResponse:
+    # Just enough of requests.Response for the gateway handlers
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncGatewayClient:
+    """aiohttp counterpart of gateways.GatewayClient, with the same ``post`` arguments.
+
+    The session, with at most ``pool_size`` connections to the provider, is
+    created on first use so it belongs to the loop the client is used from.
+    """
+
+    def __init__(self, name, base_url, pool_size=10, connect_timeout=5, read_timeout=20, headers=None):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.headers = headers or {}
+        self.session = None
+
+    async def post(self, path, json=None, data=None, headers=None):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                headers=self.headers,
+                timeout=self.timeout
+            )
+        if headers:
+            # requests leaves out headers set to None, aiohttp refuses them
+            headers = {key: value for key, value in headers.items() if value is not None}
+        async with self.session.post(f"{self.base_url}{path}", json=json, data=data, headers=headers) as response:
+            return AsyncResponse(response.status, await response.text())
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+async def run_steps_async(steps):
+    # premium.run_steps for calls that return awaitables
+    result, error = None, None
+    while True:
+        try:
+            call = steps.throw(error) if error is not None else steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = await call(), None
+        except Exception as e:
+            result, error = None, e
+
+
+class AsyncGrantService(GrantService):
+    """GrantService on AsyncMongoClient collections: the same grant steps, awaited.
+
+    Shares the premium cache with the threaded GrantService, so either one
+    invalidates what the other cached.
+    """
+
+    async def grant_premium(self, user_id, duration, payment_id):
+        return await run_steps_async(self.grant_steps(user_id, duration, payment_id))
+
+
+class AsyncCryptoCloudReconciler(CryptoCloudReconciler):
+    """The reconciler's pending-invoice bookkeeping on AsyncMongoClient collections.
+
+    Only ``forget`` is async here, for the status check coroutines. The
+    scheduled ``run`` stays with the threaded reconciler.
+    """
+
+    async def forget(self, invoice_uuid):
+        await self.pending.delete_one(self.pending_filter(invoice_uuid))
+
+
+def create_mongo_client(runtime, url, **kwargs):
+    # AsyncMongoClient binds to the loop it is created on
+    async def create():
+        return AsyncMongoClient(url, **kwargs)
+    client = runtime.run(create())
+    runtime.on_stop(client.close)
+    return client
+
+
+def create_bot(runtime, token):
+    # AsyncTeleBot for the Telegram calls async handlers make themselves (answerCallbackQuery);
+    # messages still go through the rate-limited send queue
+    bot = AsyncTeleBot(token)
+
+    async def close():
+        # The aiohttp session only exists once a request was made
+        if asyncio_helper.session_manager.session is not None:
+            await bot.close_session()
+
+    runtime.on_stop(close)
+    return bot
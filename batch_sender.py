@@ -0,0 +1,62 @@
+import logging
+import time
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+
+class BatchSender:
+    """Feed items to ``send`` in fixed-size batches at a bounded rate.
+
+    ``send`` is called once per item; an exception counts the item as skipped
+    and the run carries on with the next one. ``send`` may also return a list
+    of futures (for example from the outbound send queue), in which case the
+    whole batch is enqueued first and the item only counts as sent once all of
+    its futures succeed.
+
+    ``on_batch(batch, sent, skipped)`` is called after each batch with the
+    running totals, for checkpoints and progress reports. Returning False
+    from it stops the run.
+    """
+
+    def __init__(self, batch_size=25, per_second=20):
+        self.batch_size = batch_size
+        self.per_second = per_second
+
+    def run(self, items, send, on_batch=None):
+        sent = 0
+        skipped = 0
+        items = iter(items)
+        while True:
+            batch = list(islice(items, self.batch_size))
+            if not batch:
+                break
+
+            started = time.monotonic()
+            pending = []
+            for item in batch:
+                try:
+                    pending.append((item, send(item) or []))
+                except Exception as e:
+                    skipped += 1
+                    logger.warning(f"Skipped batch item {item!r}: {e}")
+
+            for item, futures in pending:
+                try:
+                    for future in futures:
+                        future.result()
+                    sent += 1
+                except Exception as e:
+                    skipped += 1
+                    logger.warning(f"Skipped batch item {item!r}: {e}")
+
+            if on_batch is not None and on_batch(batch, sent, skipped) is False:
+                break
+
+            # Spread the batch over at least len(batch) / per_second seconds
+            elapsed = time.monotonic() - started
+            delay = len(batch) / self.per_second - elapsed
+            if delay > 0:
+                time.sleep(delay)
+
+        return {'sent': sent, 'skipped': skipped}
@@ -0,0 +1,95 @@
+"""Micro-benchmark: linear lambda matching vs. CallbackRouter dispatch.
+
+Replays a mix of real callback data through the predicate list main.py used
+to register (one lambda per handler, checked in order) and through the
+router, and prints the cost per tap as more gateway buttons are added.
+
+    python bench/callback_router.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from router import CallbackRouter
+
+# The predicates main.py registered before the router, in registration order
+LEGACY_PREDICATES = [
+    ('buy_premium', lambda data: data == "buy_premium"),
+    ('stars_payment', lambda data: data in ["stars_payment"]),
+    ('back', lambda data: data == "back"),
+    ('stars', lambda data: data.startswith(("stars_", "tranzzo_"))),
+    ('paypal_payment', lambda data: data == "paypal_payment"),
+    ('send_payment_screenshot', lambda data: data == "send_payment_screenshot"),
+    ('accept', lambda data: data.startswith(('accept_week_', 'accept_month_', 'reject_'))),
+    ('crypto_payment', lambda data: data == "crypto_payment"),
+    ('cryptocloud', lambda data: data == "cryptocloud"),
+    ('duration', lambda data: data.startswith("duration_")),
+    ('check', lambda data: data.startswith("check_")),
+    ('cryptomus', lambda data: data == "cryptomus"),
+    ('durationmus', lambda data: data.startswith("durationmus_")),
+    ('checkmus', lambda data: data.startswith("checkmus_")),
+    ('oxapay', lambda data: data == "oxapay"),
+    ('durationoxa', lambda data: data.startswith("durationoxa_")),
+    ('checkoxa', lambda data: data.startswith("checkoxa_")),
+    ('kofi_payment', lambda data: data == "kofi_payment"),
+    ('send_payment_link', lambda data: data == "send_payment_link"),
+    ('report_problem', lambda data: data == "report_problem"),
+]
+
+EXACT = ['buy_premium', 'stars_payment', 'back', 'paypal_payment', 'send_payment_screenshot', 'crypto_payment',
+         'cryptocloud', 'cryptomus', 'oxapay', 'kofi_payment', 'send_payment_link', 'report_problem']
+PREFIXES = ['stars', 'tranzzo', 'accept', 'reject', 'duration', 'check', 'durationmus', 'checkmus',
+            'durationoxa', 'checkoxa']
+
+SAMPLE = [
+    'buy_premium', 'back', 'crypto_payment', 'oxapay', 'durationoxa_1week', 'checkoxa_12345678_1week',
+    'report_problem', 'kofi_payment', 'stars_week', 'checkmus_0f1e2d3c_1month', 'accept_week_987654321',
+]
+
+
+def build(extra):
+    # Same table plus ``extra`` fake gateways, each with an exact button and two prefixes
+    predicates = list(LEGACY_PREDICATES)
+    router = CallbackRouter()
+    noop = lambda call: None
+    router.route(*EXACT)(noop)
+    router.prefix(*PREFIXES)(noop)
+    for i in range(extra):
+        name = f"gw{i}"
+        predicates.append((name, lambda data, name=name: data == name))
+        predicates.append((f"duration{name}", lambda data, name=name: data.startswith(f"duration{name}_")))
+        predicates.append((f"check{name}", lambda data, name=name: data.startswith(f"check{name}_")))
+        router.route(name)(noop)
+        router.prefix(f"duration{name}", f"check{name}")(noop)
+    # The real gateways are registered first, so put fake gateway taps in the mix too
+    sample = SAMPLE + [f"check{name}_abc_1week" for name in (f"gw{extra - 1}",) if extra]
+    return predicates, router, sample
+
+
+def linear(predicates, sample):
+    for data in sample:
+        for _, predicate in predicates:
+            if predicate(data):
+                break
+
+
+def routed(router, sample):
+    for data in sample:
+        router.resolve(data)
+
+
+def main():
+    print(f"{'gateways':>9} {'linear ns/tap':>14} {'router ns/tap':>14}")
+    for extra in (0, 5, 20, 50):
+        predicates, router, sample = build(extra)
+        number = 2000
+        linear_time = min(timeit.repeat(lambda: linear(predicates, sample), number=number, repeat=5))
+        routed_time = min(timeit.repeat(lambda: routed(router, sample), number=number, repeat=5))
+        taps = number * len(sample)
+        print(f"{3 + extra:>9} {linear_time / taps * 1e9:>14.0f} {routed_time / taps * 1e9:>14.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+"""Offline benchmark of the real handlers in main.py.
+
+Drives synthetic updates through the same telebot dispatch the update
+workers use, with the Telegram Bot API and the payment providers stubbed
+out, mongomock standing in for MongoDB and a throwaway SQLite file for the
+support store. Reports updates/sec and p50/p99 handler latency per flow and
+writes them as JSON, so runs can be compared across changes.
+
+    pip install -r requirements-dev.txt
+    python bench/flows.py [--iterations 500] [--flow start --flow support] [--output results.json]
+
+By default the payment providers are stubbed in-process. Pass
+``--gateway-url http://127.0.0.1:8900`` to send gateway calls to
+bench/gateway_sim.py instead, with whatever latency and faults it is
+configured for.
+
+Handler latency is measured up to the point the handler returns. Outgoing
+messages are sent by the send queue workers and are not included.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ADMIN_CHAT_ID = 1000
+USER_BASE = 10 ** 9
+
+
+def setup_environment(workdir, gateway_url=None):
+    # Must run before main is imported: main reads its configuration at import time
+    if gateway_url:
+        for name in ('CRYPTOCLOUD_API_URL', 'CRYPTOMUS_API_URL', 'OXAPAY_API_URL'):
+            os.environ[name] = gateway_url
+    os.environ.update({
+        'BOT_TOKEN': '123456:bench',
+        'ADMIN_CHAT_ID': str(ADMIN_CHAT_ID),
+        'MONGO_URL': 'mongodb://bench',
+        'SQLITE_PATH': os.path.join(workdir, 'support.db'),
+        'CRYPTOCLOUD_TOKEN': 'bench', 'CRYPTOCLOUD_SHOP_ID': 'bench',
+        'CRYPTOMUS_MERCHANT_ID': 'bench', 'CRYPTOMUS_API_KEY': 'bench',
+        'OXAPAY_MERCHANT_KEY': 'bench',
+        # The stub API never rate limits, so neither should the send queue
+        'SEND_GLOBAL_RATE': '100000', 'SEND_CHAT_RATE': '100000', 'SEND_CHAT_BURST': '100000',
+        'SEND_GROUP_RATE': '100000',
+        'METRICS_ENABLED': 'false',
+        'PAYMENT_CALLBACK_URL': '',
+    })
+
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("The benchmark needs mongomock as its in-memory MongoDB: pip install -r requirements-dev.txt")
+    import pymongo
+    pymongo.MongoClient = mongomock.MongoClient
+
+
+class StubResponse:
+    def __init__(self, payload, status_code=200):
+        self.payload = payload
+        self.status_code = status_code
+        self.text = json.dumps(payload)
+        self.content = self.text.encode()
+        self.reason = 'OK'
+
+    def json(self):
+        return self.payload
+
+
+class StubTelegram:
+    """Answers Bot API calls in-process, like ``apihelper.CUSTOM_REQUEST_SENDER`` expects."""
+
+    def __init__(self):
+        self.message_ids = itertools.count(1)
+        self.calls = 0
+
+    def __call__(self, method, url, params=None, files=None, **kwargs):
+        self.calls += 1
+        api_method = url.rsplit('/', 1)[-1]
+        params = params or {}
+        if api_method in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'forwardMessage'):
+            chat_id = int(params.get('chat_id') or ADMIN_CHAT_ID)
+            result = {
+                'message_id': int(params.get('message_id') or next(self.message_ids)),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', '')
+            }
+        else:
+            result = True
+        return StubResponse({'ok': True, 'result': result})
+
+
+def stub_gateways(main):
+    # Every invoice the benchmark checks is paid, so each check runs the full grant path
+    def cryptocloud(path, **kwargs):
+        uuids = kwargs.get('json', {}).get('uuids', [])
+        return StubResponse({'status': 'success', 'result': [
+            {'uuid': uuid, 'status': 'paid', 'amount': 1} for uuid in uuids
+        ]})
+
+    def cryptomus(path, **kwargs):
+        return StubResponse({'state': 0, 'result': {'payment_status': 'paid'}})
+
+    def oxapay(path, **kwargs):
+        return StubResponse({'result': 100, 'status': 'Paid'})
+
+    main.cryptocloud_client.post = cryptocloud
+    main.cryptomus_client.post = cryptomus
+    main.oxapay_client.post = oxapay
+
+
+class Updates:
+    """Builds Update objects the way Telegram would send them."""
+
+    def __init__(self, telebot):
+        self.Update = telebot.types.Update
+        self.ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': 'Bench', 'username': f'bench{user_id}'}
+
+    def _message(self, chat_id, from_id, **fields):
+        return {
+            'message_id': next(self.ids), 'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'}, 'from': self._user(from_id), **fields
+        }
+
+    def message(self, user_id, **fields):
+        return self.Update.de_json({'update_id': next(self.ids), 'message': self._message(user_id, user_id, **fields)})
+
+    def admin_reply(self, text, replied_text, replied_id=None):
+        replied = self._message(ADMIN_CHAT_ID, 1, text=replied_text)
+        if replied_id is not None:
+            replied['message_id'] = replied_id
+        message = self._message(ADMIN_CHAT_ID, ADMIN_CHAT_ID, text=text, reply_to_message=replied)
+        return self.Update.de_json({'update_id': next(self.ids), 'message': message})
+
+    def callback(self, user_id, data):
+        return self.Update.de_json({'update_id': next(self.ids), 'callback_query': {
+            'id': str(next(self.ids)), 'chat_instance': 'bench', 'data': data, 'from': self._user(user_id),
+            'message': self._message(user_id, 1, text='menu')
+        }})
+
+
+# Each flow yields (step name, update) pairs for one simulated user
+def flow_start(u, user_id, i):
+    yield 'start', u.message(user_id, text='/start', entities=[{'type': 'bot_command', 'offset': 0, 'length': 6}])
+
+
+def flow_menu(u, user_id, i):
+    for data in ('buy_premium', 'stars_payment', 'back', 'buy_premium', 'crypto_payment', 'oxapay', 'back',
+                 'buy_premium', 'paypal_payment', 'back'):
+        yield data, u.callback(user_id, data)
+
+
+def flow_stars(u, user_id, i):
+    yield 'successful_payment', u.message(user_id, successful_payment={
+        'currency': 'XTR', 'total_amount': 46 if i % 2 else 276, 'invoice_payload': 'premium',
+        'telegram_payment_charge_id': f'bench-{user_id}-{i}', 'provider_payment_charge_id': f'p-{i}'
+    })
+
+
+def flow_gateway_check(u, user_id, i):
+    yield 'cryptocloud', u.callback(user_id, f'check_INV{user_id}x{i}')
+    yield 'cryptomus', u.callback(user_id, f'checkmus_{user_id:x}{i:x}_1week')
+    yield 'oxapay', u.callback(user_id, f'checkoxa_{user_id}{i}_1month')
+
+
+def flow_support(u, user_id, i, main=None):
+    yield 'report_problem', u.callback(user_id, 'report_problem')
+    yield 'user_message', u.message(user_id, text=f'Payment {i} did not arrive')
+    conversation_id = main.support_store.get_active_conversation(user_id)
+    # The report's admin-side message id is mapped once the send queue has delivered it
+    admin_message_id = None
+    for _ in range(100):
+        with main.support_store._lock:
+            admin_message_id = main.support_store.conn.execute(
+                'SELECT MAX(admin_message_id) FROM admin_messages WHERE conversation_id = ?', (conversation_id,)
+            ).fetchone()[0]
+        if admin_message_id is not None:
+            break
+        time.sleep(0.01)
+    replied = f"New report from User ID: {user_id}\nConversation ID: {conversation_id}\nMessage: ..."
+    yield 'admin_reply', u.admin_reply(f'Looking into it ({i})', replied, admin_message_id)
+    # Reset for the next iteration, outside the timed steps
+    main.support_store.close_conversation(conversation_id)
+    main.bot.clear_step_handler_by_chat_id(user_id)
+
+
+FLOWS = {
+    'start': flow_start,
+    'menu': flow_menu,
+    'stars_payment': flow_stars,
+    'gateway_check': flow_gateway_check,
+    'support': flow_support,
+}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed):
+    values = sorted(latencies)
+    return {
+        'updates': len(values),
+        'updates_per_sec': round(len(values) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+        'max_ms': round(values[-1] * 1000, 3) if values else 0.0,
+    }
+
+
+def run_flow(main, u, name, iterations, warmup):
+    flow = FLOWS[name]
+    steps = {}
+    total = []
+    elapsed = 0.0
+    for i in range(warmup + iterations):
+        user_id = USER_BASE + i
+        kwargs = {'main': main} if name == 'support' else {}
+        for step, update in flow(u, user_id, i, **kwargs):
+            started = time.perf_counter()
+            main.process_update(update)
+            took = time.perf_counter() - started
+            if i >= warmup:
+                elapsed += took
+                total.append(took)
+                steps.setdefault(step, []).append(took)
+
+    result = summarize(total, elapsed)
+    result['steps'] = {step: summarize(values, sum(values)) for step, values in steps.items()}
+    return result
+
+
+def wait_for_outbox(main, timeout=30):
+    deadline = time.time() + timeout
+    while (main.outbox.stats()['depth'] or main.outbox.stats()['in_flight']) and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=500, help="simulated users per flow")
+    parser.add_argument('--warmup', type=int, default=20, help="untimed iterations before measuring")
+    parser.add_argument('--flow', action='append', choices=sorted(FLOWS), help="flow to run (default: all)")
+    parser.add_argument('--gateway-url', help="use bench/gateway_sim.py at this URL instead of in-process stubs")
+    parser.add_argument('--output', help="JSON results file (default: bench/results/flows-<time>.json)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='nekopay-bench-')
+    setup_environment(workdir, args.gateway_url)
+
+    import telebot
+    from telebot import apihelper
+    stub = StubTelegram()
+    apihelper.CUSTOM_REQUEST_SENDER = stub
+
+    import main as bot_main
+    bot_main.scheduler.shutdown(wait=False)
+    if not args.gateway_url:
+        stub_gateways(bot_main)
+    u = Updates(telebot)
+
+    results = {}
+    for name in args.flow or list(FLOWS):
+        results[name] = run_flow(bot_main, u, name, args.iterations, args.warmup)
+        wait_for_outbox(bot_main)
+        r = results[name]
+        print(f"{name:>14}: {r['updates']:>6} updates  {r['updates_per_sec']:>9.1f}/s  "
+              f"p50 {r['p50_ms']:>7.3f} ms  p99 {r['p99_ms']:>7.3f} ms")
+
+    report = {
+        'benchmark': 'flows',
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'iterations': args.iterations,
+        'telegram_calls': stub.calls,
+        'gateways': args.gateway_url or 'stub',
+        'flows': results,
+    }
+    output = args.output or os.path.join(ROOT, 'bench', 'results', f"flows-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    bot_main.admin_notifier.stop()
+    bot_main.outbox.stop(timeout=5)
+    bot_main.update_executor.stop(timeout=5)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""Local stand-in for the CryptoCloud, Cryptomus and Oxapay APIs.
+
+Serves the invoice-create and status endpoints main.py calls, with the
+response fields its handlers parse, from one process. The provider paths
+do not overlap, so all three base URLs can point at the same server:
+
+    python bench/gateway_sim.py --port 8900 --latency 200 --jitter 100 --error-rate 0.05 --paid-after 10
+
+    CRYPTOCLOUD_API_URL=http://127.0.0.1:8900
+    CRYPTOMUS_API_URL=http://127.0.0.1:8900
+    OXAPAY_API_URL=http://127.0.0.1:8900
+
+An invoice reports pending until ``paid_after`` seconds after it was
+created, then paid. A ``never_paid`` fraction of invoices stays pending
+forever. Status checks for invoices the simulator never created (for
+example from bench/flows.py) create them on the spot. Settings can be
+changed while it runs, globally or per provider, to make a provider slow
+mid-test:
+
+    curl -X POST localhost:8900/_sim/config -d '{"gateway": "cryptomus", "latency_ms": 3000}'
+    curl localhost:8900/_sim/stats
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+from flask import Flask, jsonify, request
+
+GATEWAYS = ('cryptocloud', 'cryptomus', 'oxapay')
+
+DEFAULTS = {
+    'latency_ms': 0,      # added to every response
+    'jitter_ms': 0,       # plus uniform 0..jitter_ms
+    'error_rate': 0.0,    # fraction answered with HTTP 500
+    'hang_rate': 0.0,     # fraction that stall for hang_ms before answering, to trip client timeouts
+    'hang_ms': 30000,
+    'paid_after': 0.0,    # seconds from creation until an invoice reports paid
+    'never_paid': 0.0,    # fraction of invoices that never get paid
+}
+
+
+class Simulator:
+    def __init__(self, **settings):
+        self._lock = threading.Lock()
+        self.config = {gateway: dict(DEFAULTS, **settings) for gateway in GATEWAYS}
+        self.invoices = {}
+        self.stats = {gateway: {'requests': 0, 'errors': 0, 'hangs': 0, 'created': 0} for gateway in GATEWAYS}
+
+    def configure(self, gateway=None, **settings):
+        unknown = set(settings) - set(DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+        with self._lock:
+            for name in ([gateway] if gateway else GATEWAYS):
+                self.config[name].update(settings)
+
+    def delay(self, gateway):
+        # Returns an error response tuple for injected faults, else None after sleeping the latency
+        config = self.config[gateway]
+        with self._lock:
+            self.stats[gateway]['requests'] += 1
+        if random.random() < config['hang_rate']:
+            with self._lock:
+                self.stats[gateway]['hangs'] += 1
+            time.sleep(config['hang_ms'] / 1000)
+        time.sleep((config['latency_ms'] + random.uniform(0, config['jitter_ms'])) / 1000)
+        if random.random() < config['error_rate']:
+            with self._lock:
+                self.stats[gateway]['errors'] += 1
+            return jsonify({'error': 'simulated failure'}), 500
+        return None
+
+    def create(self, gateway, amount, invoice_id=None):
+        invoice_id = invoice_id or uuid.uuid4().hex
+        config = self.config[gateway]
+        with self._lock:
+            self.stats[gateway]['created'] += 1
+            self.invoices[(gateway, invoice_id)] = {
+                'amount': amount,
+                'created': time.time(),
+                'never_paid': random.random() < config['never_paid'],
+            }
+        return invoice_id
+
+    def is_paid(self, gateway, invoice_id, amount=1):
+        invoice = self.invoices.get((gateway, invoice_id))
+        if invoice is None:
+            self.create(gateway, amount, invoice_id)
+            invoice = self.invoices[(gateway, invoice_id)]
+        if invoice['never_paid']:
+            return False, invoice
+        return time.time() - invoice['created'] >= self.config[gateway]['paid_after'], invoice
+
+
+def create_app(sim):
+    app = Flask(__name__)
+
+    def body():
+        # Oxapay is sent a JSON string as form data, the others JSON
+        return request.get_json(force=True, silent=True) or {}
+
+    def base_url():
+        return request.host_url.rstrip('/')
+
+    # CryptoCloud
+    @app.route('/v2/invoice/create', methods=['POST'])
+    def cryptocloud_create():
+        fault = sim.delay('cryptocloud')
+        if fault:
+            return fault
+        amount = body().get('amount', 1)
+        invoice_id = sim.create('cryptocloud', amount, 'INV-' + uuid.uuid4().hex[:8].upper())
+        return jsonify({'status': 'success', 'result': {
+            'uuid': invoice_id, 'link': f"{base_url()}/pay/cryptocloud/{invoice_id}", 'amount': amount
+        }})
+
+    @app.route('/v2/invoice/merchant/info', methods=['POST'])
+    def cryptocloud_info():
+        fault = sim.delay('cryptocloud')
+        if fault:
+            return fault
+        result = []
+        for invoice_id in body().get('uuids', []):
+            paid, invoice = sim.is_paid('cryptocloud', invoice_id)
+            result.append({'uuid': invoice_id, 'status': 'paid' if paid else 'created', 'amount': invoice['amount']})
+        return jsonify({'status': 'success', 'result': result})
+
+    # Cryptomus
+    @app.route('/v1/payment', methods=['POST'])
+    def cryptomus_create():
+        fault = sim.delay('cryptomus')
+        if fault:
+            return fault
+        data = body()
+        invoice_id = sim.create('cryptomus', data.get('amount'))
+        return jsonify({'state': 0, 'result': {
+            'uuid': invoice_id, 'order_id': data.get('order_id'), 'amount': data.get('amount'),
+            'url': f"{base_url()}/pay/cryptomus/{invoice_id}", 'payment_status': 'check'
+        }})
+
+    @app.route('/v1/payment/info', methods=['POST'])
+    def cryptomus_info():
+        fault = sim.delay('cryptomus')
+        if fault:
+            return fault
+        invoice_id = body().get('uuid')
+        paid, invoice = sim.is_paid('cryptomus', invoice_id)
+        return jsonify({'state': 0, 'result': {
+            'uuid': invoice_id, 'amount': invoice['amount'], 'payment_status': 'paid' if paid else 'check'
+        }})
+
+    # Oxapay
+    @app.route('/merchants/request', methods=['POST'])
+    def oxapay_create():
+        fault = sim.delay('oxapay')
+        if fault:
+            return fault
+        track_id = str(random.randint(10 ** 7, 10 ** 8 - 1))
+        sim.create('oxapay', body().get('amount'), track_id)
+        return jsonify({'result': 100, 'message': 'success', 'trackId': track_id,
+                        'payLink': f"{base_url()}/pay/oxapay/{track_id}"})
+
+    @app.route('/merchants/inquiry', methods=['POST'])
+    def oxapay_inquiry():
+        fault = sim.delay('oxapay')
+        if fault:
+            return fault
+        track_id = str(body().get('trackId'))
+        paid, invoice = sim.is_paid('oxapay', track_id)
+        return jsonify({'result': 100, 'message': 'success', 'trackId': track_id,
+                        'amount': invoice['amount'], 'status': 'Paid' if paid else 'Waiting'})
+
+    # Simulator control
+    @app.route('/_sim/config', methods=['GET', 'POST'])
+    def sim_config():
+        if request.method == 'POST':
+            try:
+                sim.configure(**body())
+            except (TypeError, ValueError) as e:
+                return jsonify({'error': str(e)}), 400
+        return jsonify(sim.config)
+
+    @app.route('/_sim/stats', methods=['GET'])
+    def sim_stats():
+        return jsonify({'gateways': sim.stats, 'invoices': len(sim.invoices)})
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local payment gateway simulator")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=int(os.getenv('GATEWAY_SIM_PORT', 8900)))
+    parser.add_argument('--latency', type=float, default=0, help="milliseconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0, help="extra uniform random milliseconds")
+    parser.add_argument('--error-rate', type=float, default=0, help="fraction of requests answered with 500")
+    parser.add_argument('--hang-rate', type=float, default=0, help="fraction of requests that stall")
+    parser.add_argument('--hang', type=float, default=30000, help="milliseconds a stalled request waits")
+    parser.add_argument('--paid-after', type=float, default=0, help="seconds until an invoice reports paid")
+    parser.add_argument('--never-paid', type=float, default=0, help="fraction of invoices that stay pending")
+    parser.add_argument('--config', help="JSON file of per-gateway settings, e.g. {\"oxapay\": {\"latency_ms\": 500}}")
+    args = parser.parse_args()
+
+    sim = Simulator(
+        latency_ms=args.latency, jitter_ms=args.jitter, error_rate=args.error_rate,
+        hang_rate=args.hang_rate, hang_ms=args.hang, paid_after=args.paid_after, never_paid=args.never_paid
+    )
+    if args.config:
+        with open(args.config) as f:
+            for gateway, settings in json.load(f).items():
+                sim.configure(gateway, **settings)
+
+    create_app(sim).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
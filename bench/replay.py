@@ -0,0 +1,166 @@
+"""Replay a recorded update log through the bot against stubbed backends.
+
+Reads a log written with RECORD_UPDATES_PATH (rotated files included) and
+feeds every update through main.dispatch_updates, the same path polling
+uses, so updates go through the sharded update workers. The Telegram API
+and payment providers are stubbed as in bench/flows.py, MongoDB is
+mongomock and SQLite a temporary file.
+
+    python bench/replay.py updates.log                 # real time
+    python bench/replay.py updates.log --speed 10      # 10x faster
+    python bench/replay.py updates.log --speed max --workers 16
+
+Reports the achieved rate, how far dispatch fell behind the recorded
+schedule, and p50/p99 of queue wait plus handling per update. Results are
+written as JSON like bench/flows.py.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import flows
+from flows import ROOT, percentile
+
+
+def parse_speed(value):
+    if value == 'max':
+        return None
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or 'max'")
+    return speed
+
+
+def ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded Telegram updates against stubbed backends")
+    parser.add_argument('log', help="path of the recorded log (RECORD_UPDATES_PATH)")
+    parser.add_argument('--speed', type=parse_speed, default=1.0, help="replay speed multiplier, or 'max'")
+    parser.add_argument('--workers', type=int, help="UPDATE_WORKERS for the replay")
+    parser.add_argument('--admin-chat-id', help="ADMIN_CHAT_ID of the recorded bot, so admin replies are routed")
+    parser.add_argument('--limit', type=int, help="replay at most this many updates")
+    parser.add_argument('--gateway-url', help="use bench/gateway_sim.py at this URL instead of in-process stubs")
+    parser.add_argument('--output', help="JSON results file (default: bench/results/replay-<time>.json)")
+    args = parser.parse_args()
+
+    # Load before importing main so a bad path fails fast
+    from recorder import read_log
+    entries = list(read_log(args.log))[:args.limit]
+    if not entries:
+        sys.exit(f"No updates found in {args.log}")
+
+    flows.setup_environment(tempfile.mkdtemp(prefix='nekopay-replay-'), args.gateway_url)
+    if args.admin_chat_id:
+        os.environ['ADMIN_CHAT_ID'] = args.admin_chat_id
+    if args.workers:
+        os.environ['UPDATE_WORKERS'] = str(args.workers)
+
+    import telebot
+    from telebot import apihelper
+    stub = flows.StubTelegram()
+    apihelper.CUSTOM_REQUEST_SENDER = stub
+
+    import main as bot_main
+    bot_main.scheduler.shutdown(wait=False)
+    if not args.gateway_url:
+        flows.stub_gateways(bot_main)
+
+    # Time each update from dispatch until its worker finished it
+    executor = bot_main.update_executor
+    submitted = {}
+    latencies = []
+    handling = []
+    lock = threading.Lock()
+    handle = executor.handler
+
+    def timed_handler(update):
+        started = time.perf_counter()
+        try:
+            handle(update)
+        finally:
+            done = time.perf_counter()
+            with lock:
+                latencies.append(done - submitted.pop(id(update), started))
+                handling.append(done - started)
+
+    executor.handler = timed_handler
+
+    kinds = {}
+    first = entries[0][0]
+    behind = 0.0
+    start = time.perf_counter()
+    for recorded_at, raw in entries:
+        if args.speed:
+            due = start + (recorded_at - first) / args.speed
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                behind = max(behind, -wait)
+        update = telebot.types.Update.de_json(raw)
+        kind = next((key for key in raw if key != 'update_id'), 'unknown')
+        kinds[kind] = kinds.get(kind, 0) + 1
+        with lock:
+            submitted[id(update)] = time.perf_counter()
+        bot_main.dispatch_updates([update])
+
+    for q in executor.queues:
+        q.join()
+    elapsed = time.perf_counter() - start
+    flows.wait_for_outbox(bot_main)
+
+    latencies.sort()
+    handling.sort()
+    recorded_span = entries[-1][0] - first
+    result = {
+        'benchmark': 'replay',
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'revision': flows.git_revision(),
+        'log': os.path.abspath(args.log),
+        'speed': args.speed or 'max',
+        'workers': len(executor.queues),
+        'updates': len(entries),
+        'update_types': kinds,
+        'recorded_seconds': round(recorded_span, 3),
+        'replay_seconds': round(elapsed, 3),
+        'updates_per_sec': round(len(entries) / elapsed, 1) if elapsed else 0.0,
+        'max_behind_ms': ms(behind),
+        'latency_p50_ms': ms(percentile(latencies, 0.50)),
+        'latency_p99_ms': ms(percentile(latencies, 0.99)),
+        'handling_p50_ms': ms(percentile(handling, 0.50)),
+        'handling_p99_ms': ms(percentile(handling, 0.99)),
+        'errors': sum(shard['errors'] for shard in executor.stats()['shards']),
+        'telegram_calls': stub.calls,
+        'gateways': args.gateway_url or 'stub',
+    }
+
+    print(f"Replayed {result['updates']} updates ({result['recorded_seconds']}s recorded) "
+          f"in {result['replay_seconds']}s at {args.speed or 'max'}{'x' if args.speed else ''} speed: "
+          f"{result['updates_per_sec']}/s")
+    print(f"Latency p50 {result['latency_p50_ms']} ms, p99 {result['latency_p99_ms']} ms; "
+          f"handling p50 {result['handling_p50_ms']} ms, p99 {result['handling_p99_ms']} ms; "
+          f"dispatch fell behind by up to {result['max_behind_ms']} ms")
+
+    output = args.output or os.path.join(ROOT, 'bench', 'results', f"replay-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"Results written to {output}")
+
+    bot_main.admin_notifier.stop()
+    bot_main.outbox.stop(timeout=5)
+    executor.stop(timeout=5)
+
+
+if __name__ == '__main__':
+    main()
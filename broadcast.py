@@ -0,0 +1,198 @@
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from pymongo import ASCENDING
+
+logger = logging.getLogger(__name__)
+
+AUDIENCES = ('premium', 'all')
+
+
+def audience_filter(audience, cutoff):
+    # Users still premium at ``cutoff``, lifetime premium included
+    if audience == 'premium':
+        return {'$or': [{'expiry': {'$gt': cutoff}}, {'expiry': None}]}
+    return {}
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class Broadcaster:
+    """Send one message to every user in an audience, resumably and at a bounded rate.
+
+    The broadcast is stored in ``broadcasts`` with a checkpoint: the last
+    ``user_id`` handled and the running counts. Users are streamed from a
+    cursor sorted on the unique ``user_id`` index, starting after the
+    checkpoint. They are sent through ``sender`` (a BatchSender) via the
+    send queue, so the broadcast never exceeds the sender's rate and 429s are
+    retried. The checkpoint is written after every batch, so a restart re-sends
+    at most one batch. Only the process holding ``lease`` sends. Any process
+    calling ``resume`` takes over a broadcast whose sender died once the lease
+    expires. Progress, throughput and ETA are kept up to date in one status
+    message in the admin chat.
+    """
+
+    def __init__(self, broadcasts, users, lease, outbox, admin_chat_id, sender, report_interval=30):
+        self.broadcasts = broadcasts
+        self.users = users
+        self.lease = lease
+        self.outbox = outbox
+        self.admin_chat_id = admin_chat_id
+        self.sender = sender
+        self.report_interval = report_interval
+        self._thread = None
+        self._cancel = threading.Event()
+
+    def active(self):
+        return self.broadcasts.find_one({'status': 'running'})
+
+    def start(self, text, audience='all'):
+        if audience not in AUDIENCES:
+            raise ValueError(f"Unknown audience {audience!r}, use one of: {', '.join(AUDIENCES)}")
+        if self.active():
+            raise RuntimeError("A broadcast is already running")
+
+        now = datetime.now()
+        doc = {
+            '_id': uuid.uuid4().hex,
+            'text': text,
+            'audience': audience,
+            'cutoff': now,
+            'status': 'running',
+            'total': self.users.count_documents(audience_filter(audience, now)),
+            'sent': 0,
+            'failed': 0,
+            'last_user_id': None,
+            'status_message_id': None,
+            'created_at': now,
+            'updated_at': now
+        }
+        self.broadcasts.insert_one(doc)
+        self.resume()
+        return doc
+
+    def cancel(self):
+        result = self.broadcasts.update_many(
+            {'status': 'running'}, {'$set': {'status': 'cancelled', 'finished_at': datetime.now()}}
+        )
+        self._cancel.set()
+        return result.modified_count > 0
+
+    def resume(self):
+        # Start sending the running broadcast here unless another process holds the lease.
+        # Returns True if this call started it.
+        if self._thread is not None and self._thread.is_alive():
+            return False
+        doc = self.active()
+        if doc is None or not self.lease.acquire():
+            return False
+
+        self._cancel.clear()
+        self._thread = threading.Thread(target=self._run, args=(doc,), name='broadcast', daemon=True)
+        self._thread.start()
+        return True
+
+    def _run(self, doc):
+        try:
+            self._send_all(doc)
+        except Exception as e:
+            logger.error(f"Error in broadcast {doc['_id']}: {e}")
+        finally:
+            self.lease.release()
+
+    def _send_all(self, doc):
+        query = audience_filter(doc['audience'], doc['cutoff'])
+        if doc.get('last_user_id') is not None:
+            query['user_id'] = {'$gt': doc['last_user_id']}
+            logger.info(f"Resuming broadcast {doc['_id']} after user {doc['last_user_id']}")
+        users = self.users.find(query, {'_id': 0, 'user_id': 1}).sort('user_id', ASCENDING).batch_size(500)
+
+        base_sent = doc['sent']
+        base_failed = doc['failed']
+        started = time.monotonic()
+        last_report = [0.0]
+
+        def send(user):
+            return [self.outbox.send_message(int(user['user_id']), doc['text'])]
+
+        def on_batch(batch, sent, failed):
+            doc['last_user_id'] = batch[-1]['user_id']
+            doc['sent'] = base_sent + sent
+            doc['failed'] = base_failed + failed
+            checkpoint = self.broadcasts.update_one(
+                {'_id': doc['_id'], 'status': 'running'},
+                {'$set': {
+                    'last_user_id': doc['last_user_id'],
+                    'sent': doc['sent'],
+                    'failed': doc['failed'],
+                    'updated_at': datetime.now()
+                }}
+            )
+            if checkpoint.matched_count == 0 or self._cancel.is_set():
+                return False
+            if not self.lease.acquire():
+                logger.warning(f"Lost the broadcast lease, stopping broadcast {doc['_id']} here")
+                return False
+            if time.monotonic() - last_report[0] >= self.report_interval:
+                last_report[0] = time.monotonic()
+                self._report(doc, self._progress(doc, sent + failed, time.monotonic() - started))
+            return True
+
+        self.sender.run(users, send, on_batch=on_batch)
+        elapsed = time.monotonic() - started
+
+        finished = self.broadcasts.update_one(
+            {'_id': doc['_id'], 'status': 'running'},
+            {'$set': {'status': 'done', 'finished_at': datetime.now()}}
+        )
+        if finished.modified_count:
+            self._report(doc, f"✅ Broadcast finished: {doc['sent']} sent, {doc['failed']} failed "
+                              f"(this run took {format_duration(elapsed)})")
+        elif self.broadcasts.find_one({'_id': doc['_id'], 'status': 'cancelled'}):
+            self._report(doc, f"🛑 Broadcast cancelled: {doc['sent']} sent, {doc['failed']} failed "
+                              f"of {doc['total']}")
+
+    def _progress(self, doc, done_this_run, elapsed):
+        done = doc['sent'] + doc['failed']
+        rate = done_this_run / elapsed if elapsed > 0 else 0
+        remaining = max(doc['total'] - done, 0)
+        eta = format_duration(remaining / rate) if rate > 0 else "unknown"
+        return (f"📣 Broadcast to {doc['audience']} users: {done}/{doc['total']}\n"
+                f"Sent {doc['sent']}, failed {doc['failed']}\n"
+                f"{rate:.1f} msg/s, ETA {eta}")
+
+    def status_text(self):
+        doc = self.broadcasts.find_one({}, sort=[('created_at', -1)])
+        if doc is None:
+            return "No broadcasts yet."
+        done = doc['sent'] + doc['failed']
+        return (f"Last broadcast ({doc['audience']}, {doc['status']}): {done}/{doc['total']}, "
+                f"{doc['sent']} sent, {doc['failed']} failed")
+
+    def _report(self, doc, text):
+        # Keep one status message per broadcast up to date
+        try:
+            if doc.get('status_message_id'):
+                self.outbox.edit_message_text(text=text, chat_id=self.admin_chat_id, message_id=doc['status_message_id'])
+                return
+            sent = self.outbox.send_message(self.admin_chat_id, text)
+            sent.add_done_callback(lambda f: self._remember_status_message(doc, f))
+        except Exception as e:
+            logger.error(f"Error reporting broadcast progress: {e}")
+
+    def _remember_status_message(self, doc, future):
+        try:
+            doc['status_message_id'] = future.result().message_id
+            self.broadcasts.update_one({'_id': doc['_id']}, {'$set': {'status_message_id': doc['status_message_id']}})
+        except Exception as e:
+            logger.error(f"Error saving broadcast status message: {e}")
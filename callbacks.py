@@ -0,0 +1,70 @@
+import hashlib
+import hmac
+import json
+import logging
+
+from flask import Blueprint, request, abort
+
+from gateways import create_sign
+
+logger = logging.getLogger(__name__)
+
+# Cryptomus payment statuses that mean the invoice is settled in our favour
+CRYPTOMUS_PAID_STATUSES = ('paid', 'paid_over')
+
+
+def verify_oxapay(raw_body, signature, merchant_key):
+    expected = hmac.new(merchant_key.encode(), raw_body, hashlib.sha512).hexdigest()
+    return hmac.compare_digest(expected, signature or '')
+
+
+def verify_cryptomus(data, api_key):
+    # Cryptomus signs the PHP json_encode of the body without "sign": compact, unescaped unicode, escaped slashes
+    data = dict(data)
+    signature = data.pop('sign', '')
+    json_data = json.dumps(data, ensure_ascii=False, separators=(',', ':')).replace('/', '\\/')
+    return hmac.compare_digest(create_sign(json_data, api_key), signature or '')
+
+
+def create_blueprint(on_paid, oxapay_merchant_key=None, cryptomus_api_key=None, on_rejected=None):
+    """Payment provider push notifications.
+
+    ``on_paid(gateway, payment_id, order_id)`` is called once a verified
+    callback reports a settled payment. If it raises, the provider gets a 500
+    and retries the callback later. ``on_rejected(gateway)`` is called for a
+    callback with a bad signature.
+    """
+    bp = Blueprint('payment_callbacks', __name__, url_prefix='/callbacks')
+
+    @bp.route('/oxapay', methods=['POST'])
+    def oxapay_callback():
+        if not oxapay_merchant_key:
+            abort(404)
+        raw_body = request.get_data()
+        if not verify_oxapay(raw_body, request.headers.get('HMAC'), oxapay_merchant_key):
+            logger.warning("Rejected Oxapay callback with a bad signature")
+            if on_rejected:
+                on_rejected('oxapay')
+            abort(400)
+
+        data = json.loads(raw_body)
+        if data.get('status') == 'Paid':
+            on_paid('oxapay', str(data.get('trackId')), data.get('orderId'))
+        return 'ok'
+
+    @bp.route('/cryptomus', methods=['POST'])
+    def cryptomus_callback():
+        if not cryptomus_api_key:
+            abort(404)
+        data = request.get_json(silent=True)
+        if not data or not verify_cryptomus(data, cryptomus_api_key):
+            logger.warning("Rejected Cryptomus callback with a bad signature")
+            if on_rejected:
+                on_rejected('cryptomus')
+            abort(400)
+
+        if data.get('status') in CRYPTOMUS_PAID_STATUSES:
+            on_paid('cryptomus', data.get('uuid'), data.get('order_id'))
+        return 'ok'
+
+    return bp
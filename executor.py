@@ -0,0 +1,89 @@
+import logging
+import queue
+import threading
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+def update_chat_id(update):
+    # The chat an update belongs to, so all updates from one user land on one shard
+    message = (update.message or update.edited_message or update.channel_post
+               or update.edited_channel_post)
+    if message is not None:
+        return message.chat.id
+    if update.callback_query is not None:
+        call = update.callback_query
+        return call.message.chat.id if call.message else call.from_user.id
+    for query in (update.pre_checkout_query, update.shipping_query, update.inline_query,
+                  update.chosen_inline_result):
+        if query is not None:
+            return query.from_user.id
+    return update.update_id
+
+
+class ShardedExecutor:
+    """Run work items on N worker threads, keeping items with the same key in order.
+
+    Each key is hashed to one shard, and each shard is a bounded FIFO queue
+    drained by a single thread. Items for the same chat therefore run one at a
+    time and in arrival order, while different chats run in parallel.
+    """
+
+    def __init__(self, handler, key, shards=8, max_queue=1000, name='shard'):
+        self.handler = handler
+        self.key = key
+        self.queues = [queue.Queue(maxsize=max_queue) for _ in range(shards)]
+        self.processed = [0] * shards
+        self.errors = [0] * shards
+        self.max_queue = max_queue
+        self._threads = []
+        for index in range(shards):
+            thread = threading.Thread(target=self._worker, args=(index,), name=f'{name}-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def shard_for(self, item):
+        key = self.key(item)
+        if isinstance(key, int):
+            return key % len(self.queues)
+        return zlib.crc32(str(key).encode()) % len(self.queues)
+
+    def submit(self, item, block=True, timeout=None):
+        # Returns False if the shard is full and the item was not accepted
+        try:
+            self.queues[self.shard_for(item)].put(item, block=block, timeout=timeout)
+        except queue.Full:
+            return False
+        return True
+
+    def stats(self):
+        return {
+            'shards': [
+                {'shard': index, 'depth': q.qsize(), 'processed': self.processed[index], 'errors': self.errors[index]}
+                for index, q in enumerate(self.queues)
+            ],
+            'depth': sum(q.qsize() for q in self.queues),
+            'max_queue': self.max_queue
+        }
+
+    def stop(self, timeout=None):
+        for q in self.queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _worker(self, index):
+        q = self.queues[index]
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            try:
+                self.handler(item)
+                self.processed[index] += 1
+            except Exception as e:
+                self.errors[index] += 1
+                logger.error(f"Error in {threading.current_thread().name}: {e}")
+            finally:
+                q.task_done()
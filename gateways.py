@@ -0,0 +1,59 @@
+import base64
+import hashlib
+import json
+import logging
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class GatewayClient:
+    """Keep-alive HTTP client for a single payment provider.
+
+    Each provider gets its own ``requests.Session`` with a connection pool, so
+    repeated calls reuse the TLS connection instead of handshaking every time.
+    Every request carries a (connect, read) timeout so a stalled provider can
+    not hold a handler thread forever.
+    """
+
+    def __init__(self, name, base_url, pool_size=10, connect_timeout=5, read_timeout=20, headers=None):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if headers:
+            self.session.headers.update(headers)
+
+    def post(self, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.post(f"{self.base_url}{path}", **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def create_sign(payload, api_key):
+    # Cryptomus signature: md5(base64(json body) + api key). A pre-encoded body may be passed as a string.
+    json_data = payload if isinstance(payload, str) else json.dumps(payload)
+    base64_data = base64.b64encode(json_data.encode()).decode()
+    return hashlib.md5(f"{base64_data}{api_key}".encode()).hexdigest()
+
+
+def make_order_id(user_id, duration):
+    # Our order ids carry who paid for what, so provider callbacks need no lookup
+    return f"{user_id}_{duration}_{uuid.uuid4().hex}"
+
+
+def parse_order_id(order_id):
+    # Returns (user_id, duration), or None for orders created before ids carried them
+    parts = str(order_id or '').split('_')
+    if len(parts) != 3 or not parts[0].isdigit() or parts[1] not in ('1week', '1month'):
+        return None
+    return parts[0], parts[1]
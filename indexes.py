@@ -0,0 +1,61 @@
+import logging
+
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# (collection, keys, options) for every index the bot relies on
+INDEX_SPECS = [
+    ('users', [('user_id', ASCENDING)], {'name': 'user_id_unique', 'unique': True}),
+    ('users', [('expiry', ASCENDING)], {'name': 'expiry'}),
+    ('transactions', [('url', ASCENDING)], {'name': 'url'}),
+    # Ko-fi links are looked up by a hash of the normalized URL, see kofi.normalize_url
+    ('transactions', [('url_key', ASCENDING)], {
+        'name': 'url_key_unique',
+        'unique': True,
+        'partialFilterExpression': {'url_key': {'$exists': True}}
+    }),
+    ('pending_invoices', [('uuid', ASCENDING)], {'name': 'uuid_unique', 'unique': True}),
+    # CryptoCloud invoices that nobody paid within two days are not worth checking
+    ('pending_invoices', [('created_at', ASCENDING)], {'name': 'created_at_ttl', 'expireAfterSeconds': 2 * 24 * 3600}),
+    ('next_steps', [('expires_at', ASCENDING)], {'name': 'expires_at_ttl', 'expireAfterSeconds': 0}),
+    ('scheduler_runs', [('job', ASCENDING), ('started_at', ASCENDING)], {'name': 'job_started_at'}),
+    # Keep a month of scheduler run history
+    ('scheduler_runs', [('scheduled_at', ASCENDING)], {'name': 'scheduled_at_ttl', 'expireAfterSeconds': 30 * 24 * 3600}),
+    ('1week_prem', [('user_id', ASCENDING)], {'name': 'user_id'}),
+    ('1week_prem', [('payment_id', ASCENDING)], {
+        'name': 'payment_id_unique',
+        'unique': True,
+        'partialFilterExpression': {'payment_id': {'$exists': True}}
+    }),
+    ('1week_prem', [('expiry_date', ASCENDING)], {'name': 'expiry_date_ttl', 'expireAfterSeconds': 0}),
+    ('1month_prem', [('user_id', ASCENDING)], {'name': 'user_id'}),
+    ('1month_prem', [('payment_id', ASCENDING)], {
+        'name': 'payment_id_unique',
+        'unique': True,
+        'partialFilterExpression': {'payment_id': {'$exists': True}}
+    }),
+    ('1month_prem', [('expiry_date', ASCENDING)], {'name': 'expiry_date_ttl', 'expireAfterSeconds': 0}),
+]
+
+
+def ensure_indexes(db, specs=INDEX_SPECS):
+    """Create any missing indexes and return the ``collection.index`` names that were new.
+
+    Safe to run on every startup: existing indexes are left alone, and a
+    failure on one index (for example duplicate user ids blocking the unique
+    index) is logged without stopping the others.
+    """
+    created = []
+    for collection_name, keys, options in specs:
+        collection = db[collection_name]
+        try:
+            existing = collection.index_information()
+            if options['name'] in existing:
+                continue
+            collection.create_index(keys, **options)
+            created.append(f"{collection_name}.{options['name']}")
+        except PyMongoError as e:
+            logger.error(f"Error creating index {options['name']} on {collection_name}: {e}")
+    return created
@@ -0,0 +1,157 @@
+import hashlib
+import hmac
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from urllib.parse import parse_qs, urlsplit
+
+from flask import Blueprint, request, abort
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_url(url):
+    # Ko-fi transaction links differ in scheme, www., case, trailing slashes and extra
+    # query parameters. Only the host, the path and the txid identify a transaction.
+    url = (url or '').strip()
+    if '://' not in url:
+        url = 'https://' + url
+    parts = urlsplit(url)
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    txid = parse_qs(parts.query).get('txid')
+    query = f"?txid={txid[0].strip().lower()}" if txid else ''
+    return f"{host}{parts.path.rstrip('/').lower()}{query}"
+
+
+def url_key(url):
+    return hashlib.sha256(normalize_url(url).encode()).hexdigest()
+
+
+def transaction_type(data):
+    # Shop orders are told apart by the shop item's direct link code, which is what
+    # process_payment_link maps to a duration; anything else keeps Ko-fi's own type
+    items = data.get('shop_items') or []
+    if data.get('type') == 'Shop Order' and items:
+        return items[0].get('direct_link_code')
+    return data.get('type')
+
+
+class KofiStore:
+    """Ko-fi transactions keyed by a hash of their normalized URL.
+
+    ``find`` is one point lookup on the unique ``url_key`` index. Webhook
+    deliveries are queued by ``ingest`` and written by a background thread
+    with one unordered ``insert_many`` per batch. The batch is flushed once it
+    has ``batch_size`` transactions or is ``max_delay`` seconds old. Each caller
+    gets a Future that resolves once its transaction is stored, so the webhook
+    can still answer Ko-fi only after the write. A redelivered transaction
+    counts as stored.
+    """
+
+    def __init__(self, collection, batch_size=100, max_delay=0.05):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._writer, name='kofi-writer', daemon=True)
+        self._thread.start()
+
+    def find(self, url):
+        return self.collection.find_one({'url_key': url_key(url)})
+
+    def ingest(self, data):
+        doc = {
+            'url': data['url'],
+            'url_key': url_key(data['url']),
+            'type': transaction_type(data),
+            'kofi_type': data.get('type'),
+            'kofi_transaction_id': data.get('kofi_transaction_id'),
+            'amount': data.get('amount'),
+            'currency': data.get('currency'),
+            'timestamp': data.get('timestamp'),
+            'received_at': datetime.now()
+        }
+        future = Future()
+        self._queue.put((doc, future))
+        return future
+
+    def backfill(self):
+        # Give transactions stored before url_key existed their key, returns how many were updated
+        updated = 0
+        for doc in self.collection.find({'url_key': {'$exists': False}}, {'url': 1}):
+            try:
+                self.collection.update_one({'_id': doc['_id']}, {'$set': {'url_key': url_key(doc.get('url'))}})
+                updated += 1
+            except DuplicateKeyError:
+                logger.warning(f"Ko-fi transaction {doc['_id']} has the same normalized URL as another one")
+        return updated
+
+    def _writer(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        failed = {}
+        try:
+            self.collection.insert_many([doc for doc, _ in batch], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                if error.get('code') != 11000:
+                    failed[error['index']] = PyMongoError(error.get('errmsg'))
+        except Exception as e:
+            failed = {index: e for index in range(len(batch))}
+
+        for index, (doc, future) in enumerate(batch):
+            if index in failed:
+                logger.error(f"Error storing Ko-fi transaction {doc['url']}: {failed[index]}")
+                future.set_exception(failed[index])
+            else:
+                future.set_result(doc['url_key'])
+
+
+def create_blueprint(store, verification_token=None, timeout=10):
+    """Ko-fi webhook. Ko-fi posts form data with the transaction as JSON in ``data``.
+
+    Answers 200 once the transaction is stored, otherwise 500 so Ko-fi retries.
+    """
+    bp = Blueprint('kofi', __name__, url_prefix='/callbacks')
+
+    @bp.route('/kofi', methods=['POST'])
+    def kofi_webhook():
+        if not verification_token:
+            abort(404)
+        try:
+            data = json.loads(request.form.get('data') or request.get_data(as_text=True))
+        except ValueError:
+            abort(400)
+        if not isinstance(data, dict) or not data.get('url'):
+            abort(400)
+        if not hmac.compare_digest(str(data.get('verification_token') or ''), verification_token):
+            logger.warning("Rejected Ko-fi webhook with a bad verification token")
+            abort(403)
+
+        try:
+            store.ingest(data).result(timeout=timeout)
+        except Exception as e:
+            logger.error(f"Error ingesting Ko-fi transaction: {e}")
+            return 'error', 500
+        return 'ok'
+
+    return bp
@@ -0,0 +1,144 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED, EVENT_JOB_MISSED
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+
+class MongoLease:
+    """A named lease in Mongo that at most one process holds at a time.
+
+    The holder renews it more often than ``ttl``. If the holder dies, the lease
+    expires and the next process to call ``acquire`` takes it over. Taking the
+    lease is a single conditional upsert: it matches only when the lease is
+    ours or has expired, and a lease held by someone else makes the upsert
+    fail on the ``_id`` key.
+    """
+
+    def __init__(self, collection, name, ttl=60, owner=None):
+        self.collection = collection
+        self.name = name
+        self.ttl = ttl
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    @property
+    def is_leader(self):
+        # Also check our local view of the expiry, in case renewals stalled
+        return time.monotonic() < self._expires
+
+    def acquire(self):
+        # Take or renew the lease, returns True if we hold it afterwards
+        with self._lock:
+            started = time.monotonic()
+            now = datetime.now()
+            try:
+                self.collection.update_one(
+                    {'_id': self.name, '$or': [{'owner': self.owner}, {'expires_at': {'$lt': now}}]},
+                    {'$set': {'owner': self.owner, 'expires_at': now + timedelta(seconds=self.ttl), 'renewed_at': now}},
+                    upsert=True
+                )
+            except DuplicateKeyError:
+                if self._expires:
+                    logger.warning(f"Lost {self.name} lease, another replica holds it")
+                self._expires = 0
+                return False
+            except PyMongoError as e:
+                # Keep running until our local copy of the lease runs out
+                logger.error(f"Error renewing {self.name} lease: {e}")
+                return self.is_leader
+
+            if not self._expires:
+                logger.info(f"Acquired {self.name} lease as {self.owner}")
+            self._expires = started + self.ttl
+            return True
+
+    def release(self):
+        with self._lock:
+            if not self._expires:
+                return
+            self._expires = 0
+            try:
+                self.collection.delete_one({'_id': self.name, 'owner': self.owner})
+            except PyMongoError as e:
+                logger.error(f"Error releasing {self.name} lease: {e}")
+
+
+class LeaderJobs:
+    """Run APScheduler jobs only on the replica holding ``lease``, and record each run.
+
+    Every replica schedules the same jobs, and each replica renews the lease
+    every ``ttl / 3`` seconds. A job scheduled with ``add_job`` checks the lease
+    when it fires and returns immediately on followers, so failover happens
+    with the next run after the old leader's lease expires. Runs on the leader
+    are written to ``runs`` with their start time, duration and lag. Lag is
+    how long after its scheduled time the job actually started. Missed runs are
+    recorded too.
+    """
+
+    def __init__(self, scheduler, lease, runs):
+        self.scheduler = scheduler
+        self.lease = lease
+        self.runs = runs
+        scheduler.add_job(
+            lease.acquire, 'interval', seconds=max(lease.ttl / 3, 1),
+            id='leader-lease', max_instances=1, coalesce=True
+        )
+        scheduler.add_listener(self._record, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
+
+    def add_job(self, func, trigger, **kwargs):
+        job_id = kwargs.pop('id', func.__name__)
+        return self.scheduler.add_job(self._wrap(job_id, func), trigger, id=job_id, **kwargs)
+
+    def _wrap(self, job_id, func):
+        def run_if_leader(*args, **kwargs):
+            if not self.lease.is_leader:
+                return None
+            run = {'job': job_id, 'owner': self.lease.owner, 'started_at': datetime.now(), 'status': 'ok'}
+            started = time.time()
+            try:
+                run['result'] = func(*args, **kwargs)
+            except Exception as e:
+                run['status'] = 'error'
+                run['error'] = str(e)
+                logger.error(f"Error in scheduled job {job_id}: {e}")
+            run['duration'] = time.time() - started
+            run['_started'] = started
+            return run
+        run_if_leader.__name__ = func.__name__
+        return run_if_leader
+
+    def _record(self, event):
+        if event.code == EVENT_JOB_MISSED:
+            if not self.lease.is_leader:
+                return
+            run = {'job': event.job_id, 'owner': self.lease.owner, 'status': 'missed'}
+            lag = time.time() - event.scheduled_run_time.timestamp()
+        elif isinstance(event.retval, dict) and 'duration' in event.retval:
+            run = dict(event.retval)
+            lag = run.pop('_started') - event.scheduled_run_time.timestamp()
+            if not isinstance(run.get('result'), dict):
+                run.pop('result', None)
+        else:
+            # Lease renewals, and jobs skipped because we are not the leader
+            return
+
+        run['scheduled_at'] = event.scheduled_run_time.replace(tzinfo=None)
+        run['lag'] = max(lag, 0)
+        try:
+            self.runs.insert_one(run)
+        except PyMongoError as e:
+            logger.error(f"Error recording run of {event.job_id}: {e}")
+
+        if run['status'] != 'ok':
+            logger.warning(f"Scheduled job {event.job_id} {run['status']}, lag {run['lag']:.1f}s")
+        else:
+            logger.info(f"Scheduled job {event.job_id} took {run['duration']:.2f}s, lag {run['lag']:.1f}s")
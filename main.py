@@ -3,15 +3,32 @@ from telebot import types
 from pymongo import MongoClient
 import logging
 from datetime import datetime, timedelta
-import sqlite3
-import requests
 import os
 from dotenv import load_dotenv
 import validators
-import hashlib
 import json
-import uuid
-import base64
+import argparse
+import functools
+import webhook
+import gateways
+from gateways import create_sign, make_order_id, parse_order_id
+import callbacks
+from premium_cache import PremiumCache
+import indexes
+from premium import GrantService, ExpirySweeper
+from reconciler import CryptoCloudReconciler, CRYPTOCLOUD_PAID_STATUSES
+from batch_sender import BatchSender
+from send_queue import SendQueue
+from support_store import SupportStore
+from router import CallbackRouter
+from executor import ShardedExecutor, update_chat_id
+from step_store import MongoHandlerBackend
+from leader import MongoLease, LeaderJobs
+import metrics
+from recorder import UpdateRecorder
+import kofi as kofi_webhook
+from notifier import AdminNotifier
+from broadcast import Broadcaster, AUDIENCES
 
 # Load environment variables
 load_dotenv()
@@ -34,39 +51,222 @@ CRYPTOCLOUD_TOKEN = os.getenv('CRYPTOCLOUD_TOKEN')
 CRYPTOCLOUD_SHOP_ID = os.getenv('CRYPTOCLOUD_SHOP_ID')
 KOFI_1WEEK = os.getenv('KOFI_1WEEK')
 KOFI_1MONTH = os.getenv('KOFI_1MONTH')
+# Ko-fi webhook (/callbacks/kofi) verification token, from Ko-fi's API settings page
+KOFI_VERIFICATION_TOKEN = os.getenv('KOFI_VERIFICATION_TOKEN')
+KOFI_BATCH_SIZE = int(os.getenv('KOFI_BATCH_SIZE', 100))
+KOFI_BATCH_DELAY = float(os.getenv('KOFI_BATCH_DELAY', 0.05))
 CRYPTOMUS_MERCHANT_ID = os.getenv('CRYPTOMUS_MERCHANT_ID')
 CRYPTOMUS_API_KEY = os.getenv('CRYPTOMUS_API_KEY')
 OXAPAY_MERCHANT_KEY = os.getenv('OXAPAY_MERCHANT_KEY')
+SQLITE_PATH = os.getenv('SQLITE_PATH', '/tmp/support_bot.db')
+
+# Serving mode: long polling or webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', os.getenv('PORT', 8080)))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+# Request threads of the waitress HTTP server (webhook, payment callbacks, metrics)
+WEBHOOK_THREADS = int(os.getenv('WEBHOOK_THREADS', 8))
+
+# Update handling: worker threads (one queue each) and per-queue bound
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 8))
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 100))
+
+# Handler runtime: 'threaded' runs every handler on the update workers, 'asyncio' runs the
+# payment status checks as coroutines on one event loop (needs aiohttp and pymongo >= 4.13)
+RUNTIME = os.getenv('RUNTIME', 'threaded')
+ASYNC_MAX_TASKS = int(os.getenv('ASYNC_MAX_TASKS', 1000))
+
+# How long a pending "send me X" flow waits for the user's reply (seconds)
+NEXT_STEP_TTL = int(os.getenv('NEXT_STEP_TTL', 3600))
+
+# Public base URL for Oxapay/Cryptomus payment callbacks (served under /callbacks)
+PAYMENT_CALLBACK_URL = os.getenv('PAYMENT_CALLBACK_URL', WEBHOOK_URL)
+
+# Payment gateway HTTP settings
+GATEWAY_POOL_SIZE = int(os.getenv('GATEWAY_POOL_SIZE', 10))
+GATEWAY_CONNECT_TIMEOUT = float(os.getenv('GATEWAY_CONNECT_TIMEOUT', 5))
+GATEWAY_READ_TIMEOUT = float(os.getenv('GATEWAY_READ_TIMEOUT', 20))
+# Provider API base URLs, override to point at a sandbox or bench/gateway_sim.py
+CRYPTOCLOUD_API_URL = os.getenv('CRYPTOCLOUD_API_URL', 'https://api.cryptocloud.plus')
+CRYPTOMUS_API_URL = os.getenv('CRYPTOMUS_API_URL', 'https://api.cryptomus.com')
+OXAPAY_API_URL = os.getenv('OXAPAY_API_URL', 'https://api.oxapay.com')
+
+# Premium status cache
+PREMIUM_CACHE_SIZE = int(os.getenv('PREMIUM_CACHE_SIZE', 10000))
+PREMIUM_CACHE_TTL = int(os.getenv('PREMIUM_CACHE_TTL', 60))
+
+# Background removal of expired premium users (seconds between runs, users per delete_many)
+EXPIRY_SWEEP_INTERVAL = int(os.getenv('EXPIRY_SWEEP_INTERVAL', 600))
+EXPIRY_SWEEP_BATCH = int(os.getenv('EXPIRY_SWEEP_BATCH', 1000))
+
+# Expiry reminder sending
+REMINDER_BATCH_SIZE = int(os.getenv('REMINDER_BATCH_SIZE', 25))
+REMINDER_PER_SECOND = float(os.getenv('REMINDER_PER_SECOND', 20))
+
+# Admin /broadcast: users per batch, messages per second, seconds between progress updates
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', 25))
+BROADCAST_PER_SECOND = float(os.getenv('BROADCAST_PER_SECOND', 20))
+BROADCAST_REPORT_INTERVAL = int(os.getenv('BROADCAST_REPORT_INTERVAL', 30))
+
+# Outbound Telegram send queue
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', 4))
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', 30))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', 1))
+SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', 3))
+SEND_GROUP_RATE = float(os.getenv('SEND_GROUP_RATE', 20 / 60))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', 5))
+
+# Sales and error notices for the admin chat are sent as one digest per window (seconds, 0 = send each)
+ADMIN_DIGEST_WINDOW = int(os.getenv('ADMIN_DIGEST_WINDOW', 300))
+
+# Background check of pending CryptoCloud invoices
+CRYPTOCLOUD_RECONCILE_INTERVAL = int(os.getenv('CRYPTOCLOUD_RECONCILE_INTERVAL', 60))
+CRYPTOCLOUD_RECONCILE_BATCH = int(os.getenv('CRYPTOCLOUD_RECONCILE_BATCH', 100))
+
+# Only the replica holding the scheduler lease runs scheduled jobs; others take over after it expires
+SCHEDULER_LEASE_TTL = int(os.getenv('SCHEDULER_LEASE_TTL', 60))
+
+# Prometheus metrics on GET /metrics of the webhook/callback HTTP server
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+
+# Record incoming updates to a rotating log for bench/replay.py (empty = off)
+RECORD_UPDATES_PATH = os.getenv('RECORD_UPDATES_PATH', '')
+RECORD_MAX_BYTES = int(os.getenv('RECORD_MAX_BYTES', 50 * 1024 * 1024))
+RECORD_BACKUPS = int(os.getenv('RECORD_BACKUPS', 5))
+RECORD_REDACT = os.getenv('RECORD_REDACT', 'true').lower() in ('1', 'true', 'yes')
+
+# Metrics registry and the operation families we time
+metrics_registry = metrics.Registry()
+handler_ops = metrics_registry.operations('bot_handler', "Telegram update handler", ('kind', 'handler'))
+telegram_ops = metrics_registry.operations('telegram_api', "Telegram Bot API request", ('method',))
+gateway_ops = metrics_registry.operations('gateway_request', "Payment provider HTTP request", ('gateway', 'path'))
+mongo_ops = metrics_registry.operations('mongo_command', "MongoDB command", ('command', 'collection'))
+sqlite_ops = metrics_registry.operations('sqlite_operation', "Support store SQLite operation", ('method',))
 
 # MongoDB setup
-client = MongoClient(MONGO_URL)
+client = MongoClient(MONGO_URL, event_listeners=[metrics.MongoCommandListener(mongo_ops)] if METRICS_ENABLED else [])
 db = client['redeem_db']
 one_week_prem = db['1week_prem']
 one_month_prem = db['1month_prem']
 users_collection = db['users']
 transactionsCollection = db['transactions']
+pending_invoices = db['pending_invoices']
+# Every payment id that has granted premium, so none can be redeemed twice
+payments_collection = db['payments']
+next_steps_collection = db['next_steps']
+scheduler_leases = db['scheduler_leases']
+scheduler_runs = db['scheduler_runs']
+broadcasts_collection = db['broadcasts']
+
+# Payment gateway clients, one pooled session per provider
+cryptocloud_client = gateways.GatewayClient(
+    'cryptocloud',
+    CRYPTOCLOUD_API_URL,
+    pool_size=int(os.getenv('CRYPTOCLOUD_POOL_SIZE', GATEWAY_POOL_SIZE)),
+    connect_timeout=GATEWAY_CONNECT_TIMEOUT,
+    read_timeout=GATEWAY_READ_TIMEOUT,
+    headers={"Authorization": f"Token {CRYPTOCLOUD_TOKEN}"}
+)
+cryptomus_client = gateways.GatewayClient(
+    'cryptomus',
+    CRYPTOMUS_API_URL,
+    pool_size=int(os.getenv('CRYPTOMUS_POOL_SIZE', GATEWAY_POOL_SIZE)),
+    connect_timeout=GATEWAY_CONNECT_TIMEOUT,
+    read_timeout=GATEWAY_READ_TIMEOUT
+)
+oxapay_client = gateways.GatewayClient(
+    'oxapay',
+    OXAPAY_API_URL,
+    pool_size=int(os.getenv('OXAPAY_POOL_SIZE', GATEWAY_POOL_SIZE)),
+    connect_timeout=GATEWAY_CONNECT_TIMEOUT,
+    read_timeout=GATEWAY_READ_TIMEOUT
+)
+
+# Support conversations live in a local SQLite database
+support_store = SupportStore(SQLITE_PATH)
+
+# Next step handlers are kept in Mongo so any replica can continue a flow
+next_step_backend = MongoHandlerBackend(next_steps_collection, ttl=NEXT_STEP_TTL)
+
+# Initialize bot. Handlers run on update_executor below, not on telebot's own pool.
+bot = telebot.TeleBot(BOT_TOKEN, threaded=False, next_step_backend=next_step_backend)
+
+# Updates are sharded by chat id: one chat's updates run in order, different chats in parallel
+process_updates = bot.process_new_updates
+
+def process_update(update):
+    process_updates([update])
+
+update_executor = ShardedExecutor(
+    process_update,
+    update_chat_id,
+    shards=UPDATE_WORKERS,
+    max_queue=UPDATE_QUEUE_SIZE,
+    name='update-worker'
+)
+
+def dispatch_updates(updates):
+    # Polling blocks here when a chat's shard is full, which slows getUpdates down
+    for update in updates:
+        update_executor.submit(update)
+
+bot.process_new_updates = dispatch_updates
+
+# Handlers enqueue outgoing messages here instead of blocking on the Telegram API
+outbox = SendQueue(
+    bot,
+    workers=SEND_WORKERS,
+    global_rate=SEND_GLOBAL_RATE,
+    chat_rate=SEND_CHAT_RATE,
+    chat_burst=SEND_CHAT_BURST,
+    group_rate=SEND_GROUP_RATE,
+    max_retries=SEND_MAX_RETRIES
+)
+
+# Sale, error and support notices for the admin chat, coalesced into digests
+admin_notifier = AdminNotifier(lambda text: outbox.send_message(ADMIN_CHAT_ID, text), window=ADMIN_DIGEST_WINDOW)
 
-# Initialize bot
-bot = telebot.TeleBot(BOT_TOKEN)
+# Read-through cache of premium state, invalidated by every grant path
+premium_cache = PremiumCache(maxsize=PREMIUM_CACHE_SIZE, ttl=PREMIUM_CACHE_TTL)
+
+# Every payment path grants premium through this service
+grants = GrantService(users_collection, one_week_prem, one_month_prem, payments_collection, cache=premium_cache)
+
+# Expired users are deleted by a scheduled sweep, so premium checks stay read-only
+expiry_sweeper = ExpirySweeper(
+    users_collection, one_week_prem, one_month_prem, cache=premium_cache, batch_size=EXPIRY_SWEEP_BATCH
+)
+
+def get_premium_state(user_id):
+    # Returns the user's premium fields, or None if the user has no premium record
+    user_id = str(user_id)
+    return premium_cache.get(
+        user_id,
+        lambda: users_collection.find_one({'user_id': user_id}, {'_id': 0, 'expiry': 1, 'premium_duration': 1})
+    )
 
 def check_user_id(user_id):
-    # Convert user_id to string before checking
-    user = users_collection.find_one({'user_id': str(user_id)})
+    # Pure read: expired users are removed by expiry_sweeper, never here
+    user = get_premium_state(user_id)
     if user is None:
         return False
-        
-    # Check if premium has expired
-    if 'expiry' in user and user['expiry']:
-        if user['expiry'] < datetime.now():
-            # Remove expired user
-            users_collection.delete_one({'user_id': str(user_id)})
-            one_week_prem.delete_one({'user_id': str(user_id)})
-            one_month_prem.delete_one({'user_id': str(user_id)})
-            return False
-            
-    return True
+    return not user.get('expiry') or user['expiry'] >= datetime.now()
+
+def cached_markup(build):
+    # Build an inline keyboard once per set of arguments and keep its JSON.
+    # telebot sends a string reply_markup as-is, so taps skip both the
+    # object construction and the serialization.
+    @functools.lru_cache(maxsize=None)
+    def wrapper(*args):
+        return build(*args).to_json()
+    return functools.update_wrapper(wrapper, build)
 
 # Function to create the premium keyboard
+@cached_markup
 def create_premium_keyboard():
     keyboard = types.InlineKeyboardMarkup(row_width=1)
     
@@ -89,6 +289,7 @@ def create_premium_keyboard():
     keyboard.add(buy_premium, report_button, link_button)
     return keyboard
 
+@cached_markup
 def payment_methods_keyboard():
     keyboard = types.InlineKeyboardMarkup(row_width=1)
     
@@ -117,6 +318,7 @@ def payment_methods_keyboard():
     keyboard.add(stars_button, paypal_button, crypto_button, kofi_button, backs)
     return keyboard
 
+@cached_markup
 def paypal_keyboard():
     keyboard = types.InlineKeyboardMarkup(row_width=1)
     week_button = types.InlineKeyboardButton(
@@ -138,6 +340,7 @@ def paypal_keyboard():
     keyboard.add(week_button, month_button, photo_button, backs)
     return keyboard
 
+@cached_markup
 def paynow(payment_type):
     keyboard = types.InlineKeyboardMarkup(row_width=1)
     
@@ -158,6 +361,7 @@ def paynow(payment_type):
     keyboard.add(week_button, month_button, backs)
     return keyboard
 
+@cached_markup
 def kofi():
     keyboard = types.InlineKeyboardMarkup(row_width=1)
     week_button = types.InlineKeyboardButton(
@@ -179,32 +383,189 @@ def kofi():
     keyboard.add(week_button, month_button, photo_button, backs)
     return keyboard
 
+@cached_markup
+def crypto_gateways_keyboard():
+    keyboard = types.InlineKeyboardMarkup(row_width=1)
+    cryptocloud = types.InlineKeyboardButton("CryptoCloud", callback_data="cryptocloud")
+    cryptomus = types.InlineKeyboardButton("CryptoMus", callback_data="cryptomus")
+    oxapay = types.InlineKeyboardButton("Oxapay", callback_data="oxapay")
+    backs = types.InlineKeyboardButton("Back", callback_data="back")
+    keyboard.add(cryptocloud, cryptomus, oxapay, backs)
+    return keyboard
+
+@cached_markup
+def duration_keyboard(prefix):
+    keyboard = types.InlineKeyboardMarkup()
+    keyboard.row(
+        types.InlineKeyboardButton("1 Week ($1)", callback_data=f"{prefix}_1week"),
+        types.InlineKeyboardButton("1 Month ($6)", callback_data=f"{prefix}_1month")
+    )
+    return keyboard
+
+@cached_markup
+def upgrade_keyboard():
+    keyboard = types.InlineKeyboardMarkup()
+    keyboard.add(types.InlineKeyboardButton("Upgrade to Premium", callback_data="buy_premium"))
+    return keyboard
+
+# Static guide screens
+STARS_GUIDE = """
+    Here is payment using telegram stars
+    1. Select your premium duration
+    2. Then you will get invoice. Click it
+    3. After payment, you will automatically activated the premium!
+    
+    If you have a trouble with payment, please contact us using /start and select report problem or suggestion
+    """
+
+PAYPAL_GUIDE = """
+    Here is a payment guide for paypal payment:
+    1. Select your premium duration
+    2. Click the invoice link
+    3. Pay it
+    4. After payment, click the send payment screenshot button to verify your payment
+    5. Send your success payment screenshot
+    6. Wait until admin accept it
+    7. Enjoy your premium features!
+    
+    If you have a trouble with payment, please contact us using /start and select report problem or suggestion
+    """
+
+CRYPTO_GUIDE = """
+    Here is a payment guide for crypto payment:
+
+    Using crypto payment has a service fee and network fee, so there might be a slight difference in the amount you need to pay.
+
+    Supported currencies:
+
+    CryptoCloud:
+    - BTC (Bitcoin)
+    - ETH (Ethereum)
+    - LTC (Litecoin)
+    - USDT (TRC20)
+    - USDT (ERC20)
+    - USDC (TRC20)
+    - TUSD (TRC20)
+    - TON (Toncoin)
+
+    CryptoMus:
+    - AVAX (Avalanche)
+    - BCH (Bitcoin Cash)
+    - BNB (Binance Smart Chain)
+    - BTC (Bitcoin)
+    - DAI (Ethereum, Binance Smart Chain, Polygon)
+    - DASH (Dash)
+    - DOGE (Dogecoin)
+    - ETH (Arbitrum, Ethereum, Binance Smart Chain)
+    - HMSTR (Toncoin)
+    - LTC (Litecoin)
+    - POL (Polygon, Ethereum)
+    - SHIB (Ethereum)
+    - TON (Toncoin)
+    - TRX (Tron)
+    - USDC (Ethereum, Binance Smart Chain, Arbitrum, Polygon, Avalanche)
+    - USDT (Toncoin, Avalanche, Arbitrum, Binance Smart Chain, Ethereum, Polygon, Tron)
+    - VERSE (Ethereum)
+    - XMR (Monero)
+    
+    Oxapay:
+    - Bitcoin Cash (BCH)
+    - Binance Coin (BNB)
+    - Bitcoin (BTC)
+    - Dogecoin (DOGE)
+    - Dogs (DOGS)
+    - Ethereum (ETH)
+    - Litecoin (LTC)
+    - NotCoin (NOT)
+    - Polygon (POL)
+    - Shiba Inu (SHIB)
+    - Solana (SOL)
+    - Toncoin (TON)
+    - Tron (TRX)
+    - USD Coin (USDC)
+    - Tether (USDT)
+    - Monero (XMR)
+    
+    How to pay?
+    1. First, select the crypto gateway you want to pay here
+    2. After that, select your premium duration
+    3. You will get a payment link to pay
+    4. Open the link, and select crypto currencies also crypto network
+    5. Pay with the amount shown in the link
+    6. After payment, click the check payment button to verify your payment
+    7. Enjoy your premium features!
+    
+    If you have a trouble with payment, please contact us using /start and select report problem or suggestion
+    """
+
+KOFI_GUIDE = """
+        How to pay with kofi?
+        
+        1. Select the duration you want to buy at here button
+        2. Click the button below go to purchase the payment 
+        3. After payment, you will directed to payment success page. Then, you should copy your payment sucess link
+        4. Back to bot and click the button below to send your payment link
+        5. Paste your payment link
+        6. Done! Your premium will be activated
+        
+        If you have a trouble with payment, please contact our support. use /start and select report problem
+        """
+
+def warm_up_screens():
+    # Build every static keyboard at startup so the first taps are as cheap as the rest
+    create_premium_keyboard()
+    payment_methods_keyboard()
+    paypal_keyboard()
+    paynow("stars")
+    kofi()
+    crypto_gateways_keyboard()
+    for prefix in ("duration", "durationmus", "durationoxa"):
+        duration_keyboard(prefix)
+    upgrade_keyboard()
+
+warm_up_screens()
+
 def setup_database():
     try:
-        # Use /tmp directory for SQLite database on Vercel
-        db_path = '/tmp/support_bot.db'
-        with sqlite3.connect(db_path) as conn:
-            c = conn.cursor()
-            c.execute('''CREATE TABLE IF NOT EXISTS conversations (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            user_id INTEGER NOT NULL,
-                            status TEXT NOT NULL,
-                            created_at TIMESTAMP NOT NULL,
-                            closed_at TIMESTAMP)''')
-            c.execute('''CREATE TABLE IF NOT EXISTS messages (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            conversation_id INTEGER NOT NULL,
-                            from_user BOOLEAN NOT NULL,
-                            message_text TEXT NOT NULL,
-                            timestamp TIMESTAMP NOT NULL,
-                            FOREIGN KEY (conversation_id) REFERENCES conversations (id))''')
-            conn.commit()
+        support_store.setup()
         logger.info("Database setup completed successfully")
     except Exception as e:
         logger.error(f"Error setting up database: {e}")
 
 setup_database()
 
+def setup_mongo_indexes():
+    try:
+        created = indexes.ensure_indexes(db)
+        if created:
+            logger.info(f"Created MongoDB indexes: {', '.join(created)}")
+        else:
+            logger.info("MongoDB indexes already up to date")
+    except Exception as e:
+        logger.error(f"Error setting up MongoDB indexes: {e}")
+
+setup_mongo_indexes()
+
+# Ko-fi transactions, looked up by a hash of the normalized link
+kofi_store = kofi_webhook.KofiStore(transactionsCollection, batch_size=KOFI_BATCH_SIZE, max_delay=KOFI_BATCH_DELAY)
+
+def setup_kofi_store():
+    try:
+        updated = kofi_store.backfill()
+        if updated:
+            logger.info(f"Added URL keys to {updated} Ko-fi transactions")
+    except Exception as e:
+        logger.error(f"Error backfilling Ko-fi URL keys: {e}")
+
+setup_kofi_store()
+
+# All inline button presses go through one handler and a dict-based router
+callback_router = CallbackRouter()
+
+@bot.callback_query_handler(func=lambda call: True)
+def route_callback(call):
+    callback_router.dispatch(call)
+
 # Handler for the '/start' command
 @bot.message_handler(commands=['start'])
 def handle_start(message):
@@ -213,40 +574,33 @@ def handle_start(message):
         keyboard = create_premium_keyboard()
 
         # Send the message with the inline keyboard
-        bot.send_message(
+        outbox.send_message(
             message.chat.id,
             "🌟 Welcome to Nekozu Support And Payment! Choose an option below:",
             reply_markup=keyboard
         )
     except Exception as e:
-        bot.reply_to(message, "Sorry, there was an error. Please try again later.")
+        outbox.reply_to(message, "Sorry, there was an error. Please try again later.")
         print(f"Error in start handler: {e}")
       
-@bot.callback_query_handler(func=lambda call: call.data == "buy_premium")
+@callback_router.route("buy_premium")
 def handleprem(call):
     keyboard = payment_methods_keyboard()
-    bot.edit_message_reply_markup(call.message.chat.id, call.message.id, reply_markup=keyboard)
+    outbox.edit_message_reply_markup(call.message.chat.id, call.message.id, reply_markup=keyboard)
         
-@bot.callback_query_handler(func=lambda call: call.data in ["stars_payment"])
+@callback_router.route("stars_payment")
 def handlepay(call):
     payment_type = "stars"
     keyboard = paynow(payment_type)
-    text = """"
-    Here is payment using telegram stars
-    1. Select your premium duration
-    2. Then you will get invoice. Click it
-    3. After payment, you will automatically activated the premium!
-    
-    If you have a trouble with payment, please contact us using /start and select report problem or suggestion
-    """
-    bot.edit_message_reply_markup(text, call.message.chat.id, call.message.id, reply_markup=keyboard)
+    text = STARS_GUIDE
+    outbox.edit_message_text(text, call.message.chat.id, call.message.id, reply_markup=keyboard)
     
-@bot.callback_query_handler(func=lambda call: call.data == "back")    
+@callback_router.route("back")
 def handleback(call):
     keyboard = create_premium_keyboard()
-    bot.edit_message_reply_markup(call.message.chat.id, call.message.id, reply_markup=keyboard)
+    outbox.edit_message_reply_markup(call.message.chat.id, call.message.id, reply_markup=keyboard)
     
-@bot.callback_query_handler(func=lambda call: call.data.startswith(("stars_", "tranzzo_")))
+@callback_router.prefix("stars", "tranzzo")
 def handle_premium_selection(call):
     try:
         chat_id = call.message.chat.id
@@ -316,76 +670,50 @@ def handle_successful_payment(message):
     try:
         payment_info = message.successful_payment
         duration = "1week" if payment_info.total_amount == 46 else "1month"
-        expiry = datetime.now() + timedelta(weeks=1 if duration == "1week" else 4)
-
-        # Prepare payment data
-        payment_data = {
-            'user_id': str(message.from_user.id),
-            'expiry_date': expiry
-        }
 
-        # Store payment in appropriate collection
-        if duration == "1week":
-            one_week_prem.insert_one(payment_data)
-        else:
-            one_month_prem.insert_one(payment_data)
-
-        # Update user's premium status
-        users_collection.update_one(
-            {'user_id': str(message.from_user.id)},
-            {
-                '$set': {
-                    'is_premium': True,
-                    'premium_start': datetime.now(),
-                    'premium_duration': duration,
-                    'expiry': expiry
-                }
-            },
-            upsert=True
-        )
+        # Telegram may redeliver the update, the charge id makes the grant idempotent
+        if not grants.grant_premium(message.from_user.id, duration, f"stars:{payment_info.telegram_payment_charge_id}"):
+            return
 
         # Send success message
-        bot.send_message(
+        outbox.send_message(
             message.chat.id,
             f"✨ Thank you! Your payment of {payment_info.total_amount} Amount has been received!\n\n"
             f"▶️ Your {duration} premium subscription is now active\n\nYou can check it using /info command!"
             "🎉 Enjoy your premium features!"
         )
-        bot.send_message(
-            ADMIN_CHAT_ID,
-            f"Someone just bought premium with amount {payment_info.total_amount}"
+        admin_notifier.sale(
+            "Stars",
+            detail=message.from_user.id,
+            amount=payment_info.total_amount,
+            text=f"Someone just bought premium with amount {payment_info.total_amount}"
         )
 
     except Exception as e:
         logger.error(f"Error in payment success handler: {e}")
-        bot.reply_to(
+        # The user has paid but has no premium, so the admin must hear about it now
+        admin_notifier.error(
+            "Stars payment", e,
+            text=f"Stars payment from user {message.from_user.id} was received but premium was not granted: {e}",
+            urgent=True
+        )
+        outbox.reply_to(
             message,
             "Your payment was received, but there was an error updating your premium status. "
             "Please contact support using /start and select report with your screenshot the error."
         )
 
-@bot.callback_query_handler(func=lambda call: call.data == "paypal_payment")
+@callback_router.route("paypal_payment")
 def handle_paypal(call):
     keyboard = paypal_keyboard()
-    text = """
-    Here is a payment guide for paypal payment:
-    1. Select your premium duration
-    2. Click the invoice link
-    3. Pay it
-    4. After payment, click the send payment screenshot button to verify your payment
-    5. Send your success payment screenshot
-    6. Wait until admin accept it
-    7. Enjoy your premium features!
-    
-    If you have a trouble with payment, please contact us using /start and select report problem or suggestion
-    """
-    bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.id, text=text, reply_markup=keyboard)
+    text = PAYPAL_GUIDE
+    outbox.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.id, text=text, reply_markup=keyboard)
 
-@bot.callback_query_handler(func=lambda call: call.data == "send_payment_screenshot")
+@callback_router.route("send_payment_screenshot")
 def handle_send_payment_screenshot(call):
     force_reply = types.ForceReply(selective=True)
-    msg = bot.send_message(call.message.chat.id, "Please send your payment screenshot.", reply_markup=force_reply)
-    bot.register_next_step_handler(msg, process_payment_screenshot)
+    outbox.send_message(call.message.chat.id, "Please send your payment screenshot.", reply_markup=force_reply)
+    bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_payment_screenshot)
 
 @bot.message_handler(content_types=['photo'])
 def process_payment_screenshot(message):
@@ -404,58 +732,38 @@ def process_payment_screenshot(message):
         keyboard.add(week_accept, month_accept, reject)
 
         # Forward screenshot to admin with verification buttons
-        bot.forward_message(ADMIN_CHAT_ID, message.chat.id, message.message_id)
+        outbox.forward_message(ADMIN_CHAT_ID, message.chat.id, message.message_id)
         admin_msg = f"Payment screenshot from:\nUser ID: {message.from_user.id}\nUsername: @{message.from_user.username}\n\nPlease verify:"
-        bot.send_message(ADMIN_CHAT_ID, admin_msg, reply_markup=keyboard)
+        outbox.send_message(ADMIN_CHAT_ID, admin_msg, reply_markup=keyboard)
         
         # Send confirmation to user
-        bot.reply_to(message, "Thank you! Your payment screenshot has been received and is being reviewed. Please wait for confirmation.")
+        outbox.reply_to(message, "Thank you! Your payment screenshot has been received and is being reviewed. Please wait for confirmation.")
         
     except Exception as e:
         logger.error(f"Error processing payment screenshot: {e}")
-        bot.reply_to(message, "Sorry, there was an error processing your screenshot. Please try again or contact support.")
+        outbox.reply_to(message, "Sorry, there was an error processing your screenshot. Please try again or contact support.")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith(('accept_week_', 'accept_month_', 'reject_')))
+@callback_router.prefix("accept", "reject")
 def handle_admin_verification(call):
     try:
         action, user_id = call.data.rsplit('_', 1)  # Split from right to handle underscores in user_id
         
         if action == 'reject':
             # Send rejection message to user
-            bot.send_message(int(user_id), "❌ Your payment screenshot was rejected. Please ensure you sent the correct screenshot and try again.")
+            outbox.send_message(int(user_id), "❌ Your payment screenshot was rejected. Please ensure you sent the correct screenshot and try again.")
             bot.answer_callback_query(call.id, "Rejection sent to user")
             
         elif action in ['accept_week', 'accept_month']:
             duration = "1week" if action == 'accept_week' else "1month"
-            expiry = datetime.now() + timedelta(weeks=1 if duration == "1week" else 4)
-            
-            # Add user to appropriate collection
-            payment_data = {
-                'user_id': str(user_id),  # Convert to string to match check_user_id format
-                'expiry_date': expiry
-            }
-            
-            if duration == "1week":
-                one_week_prem.insert_one(payment_data)
-            else:
-                one_month_prem.insert_one(payment_data)
-
-            # Update user's premium status in users collection
-            users_collection.update_one(
-                {'user_id': str(user_id)},  # Convert to string to match check_user_id format
-                {
-                    '$set': {
-                        'is_premium': True,
-                        'premium_start': datetime.now(),
-                        'premium_duration': duration,
-                        'expiry': expiry
-                    }
-                },
-                upsert=True
-            )
+
+            # PayPal has no payment id we can see, so the admin verification message stands in for it
+            payment_id = f"paypal:{call.message.chat.id}:{call.message.message_id}"
+            if not grants.grant_premium(user_id, duration, payment_id):
+                bot.answer_callback_query(call.id, "This payment was already accepted")
+                return
 
             # Send confirmation to user
-            bot.send_message(
+            outbox.send_message(
                 int(user_id),
                 f"✨ Your payment has been verified!\n\n▶️ Your {duration} premium subscription is now active.\n\n"
                 "You can check it using /info command!\n🎉 Enjoy your premium features!"
@@ -463,7 +771,7 @@ def handle_admin_verification(call):
             bot.answer_callback_query(call.id, f"Premium {duration} activated for user")
 
         # Update admin message
-        bot.edit_message_reply_markup(
+        outbox.edit_message_reply_markup(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             reply_markup=None
@@ -471,7 +779,7 @@ def handle_admin_verification(call):
 
         # Update admin message text
         action_text = "rejected" if action == "reject" else f"accepted ({duration})"
-        bot.edit_message_text(
+        outbox.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text=f"{call.message.text}\n\nStatus: {action_text}"
@@ -482,94 +790,20 @@ def handle_admin_verification(call):
         bot.answer_callback_query(call.id, f"Error processing verification: {str(e)}", show_alert=True)
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "crypto_payment")
+@callback_router.route("crypto_payment")
 def handle_crypto(call):
-    message = """
-    Here is a payment guide for crypto payment:
-
-    Using crypto payment has a service fee and network fee, so there might be a slight difference in the amount you need to pay.
-
-    Supported currencies:
-
-    CryptoCloud:
-    - BTC (Bitcoin)
-    - ETH (Ethereum)
-    - LTC (Litecoin)
-    - USDT (TRC20)
-    - USDT (ERC20)
-    - USDC (TRC20)
-    - TUSD (TRC20)
-    - TON (Toncoin)
-
-    CryptoMus:
-    - AVAX (Avalanche)
-    - BCH (Bitcoin Cash)
-    - BNB (Binance Smart Chain)
-    - BTC (Bitcoin)
-    - DAI (Ethereum, Binance Smart Chain, Polygon)
-    - DASH (Dash)
-    - DOGE (Dogecoin)
-    - ETH (Arbitrum, Ethereum, Binance Smart Chain)
-    - HMSTR (Toncoin)
-    - LTC (Litecoin)
-    - POL (Polygon, Ethereum)
-    - SHIB (Ethereum)
-    - TON (Toncoin)
-    - TRX (Tron)
-    - USDC (Ethereum, Binance Smart Chain, Arbitrum, Polygon, Avalanche)
-    - USDT (Toncoin, Avalanche, Arbitrum, Binance Smart Chain, Ethereum, Polygon, Tron)
-    - VERSE (Ethereum)
-    - XMR (Monero)
-    
-    Oxapay:
-    - Bitcoin Cash (BCH)
-    - Binance Coin (BNB)
-    - Bitcoin (BTC)
-    - Dogecoin (DOGE)
-    - Dogs (DOGS)
-    - Ethereum (ETH)
-    - Litecoin (LTC)
-    - NotCoin (NOT)
-    - Polygon (POL)
-    - Shiba Inu (SHIB)
-    - Solana (SOL)
-    - Toncoin (TON)
-    - Tron (TRX)
-    - USD Coin (USDC)
-    - Tether (USDT)
-    - Monero (XMR)
-    
-    How to pay?
-    1. First, select the crypto gateway you want to pay here
-    2. After that, select your premium duration
-    3. You will get a payment link to pay
-    4. Open the link, and select crypto currencies also crypto network
-    5. Pay with the amount shown in the link
-    6. After payment, click the check payment button to verify your payment
-    7. Enjoy your premium features!
-    
-    If you have a trouble with payment, please contact us using /start and select report problem or suggestion
-    """
-    keyboard = types.InlineKeyboardMarkup(row_width=1)
-    cryptocloud = types.InlineKeyboardButton("CryptoCloud", callback_data="cryptocloud")
-    cryptomus = types.InlineKeyboardButton("CryptoMus", callback_data="cryptomus")
-    oxapay = types.InlineKeyboardButton("Oxapay", callback_data="oxapay")
-    backs = types.InlineKeyboardButton("Back", callback_data="back")
-    keyboard.add(cryptocloud, cryptomus, oxapay, backs)
-    bot.edit_message_text(message, call.message.chat.id, call.message.id, reply_markup=keyboard)
+    message = CRYPTO_GUIDE
+    keyboard = crypto_gateways_keyboard()
+    outbox.edit_message_text(message, call.message.chat.id, call.message.id, reply_markup=keyboard)
     
     
-@bot.callback_query_handler(func=lambda call: call.data == "cryptocloud")
+@callback_router.route("cryptocloud")
 def handle_cryptocloud(call):
     try:
         # Create keyboard with duration options
-        keyboard = types.InlineKeyboardMarkup()
-        keyboard.row(
-            types.InlineKeyboardButton("1 Week ($1)", callback_data="duration_1week"),
-            types.InlineKeyboardButton("1 Month ($6)", callback_data="duration_1month")
-        )
+        keyboard = duration_keyboard("duration")
 
-        bot.edit_message_text(
+        outbox.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text="Please select your premium subscription duration:",
@@ -580,25 +814,20 @@ def handle_cryptocloud(call):
         logger.error(f"Error creating payment: {e}")
         bot.answer_callback_query(call.id, "Error creating payment. Please try again later.", show_alert=True)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("duration_"))
+@callback_router.prefix("duration")
 def handle_duration_selection(call):
     try:
         duration = call.data.split("_")[1]
         amount = 1 if duration == "1week" else 6
 
         # Create payment invoice
-        create_url = "https://api.cryptocloud.plus/v2/invoice/create"
         create_data = {
             "amount": amount,
             "shop_id": CRYPTOCLOUD_SHOP_ID,
             "currency": "USD"
         }
 
-        headers = {
-            "Authorization": f"Token {CRYPTOCLOUD_TOKEN}"
-        }
-
-        create_response = requests.post(create_url, headers=headers, json=create_data)
+        create_response = cryptocloud_client.post("/v2/invoice/create", json=create_data)
 
         if create_response.status_code == 200:
             invoice_data = create_response.json()
@@ -606,6 +835,15 @@ def handle_duration_selection(call):
                 invoice_uuid = invoice_data["result"]["uuid"]
                 pay_url = invoice_data["result"]["link"]
 
+                # Let the reconciler activate it even if the user never taps "Check Payment"
+                try:
+                    cryptocloud_reconciler.record(
+                        invoice_uuid, call.from_user.id, duration, amount,
+                        chat_id=call.message.chat.id, message_id=call.message.message_id
+                    )
+                except Exception as e:
+                    logger.error(f"Error recording pending invoice {invoice_uuid}: {e}")
+
                 # Create keyboard with payment URL
                 keyboard = types.InlineKeyboardMarkup()
                 keyboard.add(
@@ -613,7 +851,7 @@ def handle_duration_selection(call):
                     types.InlineKeyboardButton("Check Payment", callback_data=f"check_{invoice_uuid}")
                 )
 
-                bot.edit_message_text(
+                outbox.edit_message_text(
                     chat_id=call.message.chat.id,
                     message_id=call.message.message_id,
                     text=f"Please complete your payment for {duration} premium subscription.\nAmount: ${amount}",
@@ -628,91 +866,172 @@ def handle_duration_selection(call):
         logger.error(f"Error processing duration selection: {e}")
         bot.answer_callback_query(call.id, "Error processing selection. Please try again.", show_alert=True)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("check_"))
-def check_payment_status(call):
+# Payment status checks. Each provider has a request builder and a response parser, and
+# the result is settled by payment_checked. The handlers below and the coroutines of the
+# asyncio runtime share all of it, so only how the I/O is done differs between them.
+def cryptocloud_status_request(call):
+    # Returns (payment id, path, post arguments)
+    invoice_uuid = call.data.split("_")[1]
+    return invoice_uuid, "/v2/invoice/merchant/info", {'json': {"uuids": [invoice_uuid]}}
+
+def cryptocloud_status_result(call, response):
+    # Returns (duration, None) once paid, otherwise (None, alert for the user)
+    if response.status_code == 200:
+        data = response.json()
+        if data["status"] == "success":
+            for invoice in data["result"]:
+                if invoice["status"] in CRYPTOCLOUD_PAID_STATUSES:
+                    # Get duration from invoice amount
+                    return "1week" if invoice["amount"] == 1 else "1month", None
+                elif invoice["status"] == "created":
+                    return None, "Payment pending. Please complete the payment."
+    return None, "Please paid the payment first"
+
+def cryptomus_status_request(call):
+    _, payment_uuid, duration = call.data.split("_")
+    payment_data = {
+        "uuid": payment_uuid
+    }
+    headers = {
+        'merchant': CRYPTOMUS_MERCHANT_ID,
+        'sign': create_sign(payment_data, CRYPTOMUS_API_KEY),
+        'Content-Type': 'application/json'
+    }
+    return payment_uuid, '/v1/payment/info', {'headers': headers, 'json': payment_data}
+
+def cryptomus_status_result(call, response):
+    payment_status = response.json().get('result', {}).get('payment_status')
+    if payment_status == 'paid':
+        return call.data.split("_")[2], None
+    return None, f"Payment status: {payment_status}. Please complete payment."
+
+def oxapay_status_request(call):
+    _, track_id, duration = call.data.split("_")
+    data = {
+        'merchant': OXAPAY_MERCHANT_KEY,
+        'trackId': track_id
+    }
+    return track_id, '/merchants/inquiry', {'data': json.dumps(data)}
+
+def oxapay_status_result(call, response):
+    result = response.json()
+    if result.get('status') == 'Paid':
+        return call.data.split("_")[2], None
+    return None, f"Payment status: {result.get('status')}. Please complete payment."
+
+def payment_checked(call, gateway, duration, granted):
+    # Tell the user about a paid invoice; returns the alert to answer the tap with, if any
+    if not granted:
+        return "This payment has already been applied."
+
+    if gateway == 'cryptocloud':
+        outbox.edit_message_text(
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            text=f"✨ Your payment has been verified!\n\n▶️ Your {duration} premium subscription is now active.\n\n"
+                "You can check it using /info command!\n🎉 Enjoy your premium features!"
+        )
+        return "Payment confirmed! Processing your premium activation..."
+
+    outbox.edit_message_text(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=f"✨ Payment successful!\n\n▶️ Your {duration} premium is now active\n\nUse /info to check your status!",
+        reply_markup=None
+    )
+    admin_notifier.sale(gateway.capitalize(), detail=f"{call.from_user.username} ({call.from_user.id})")
+    return None
+
+def status_check_failed(gateway, error):
+    # Report a failed status check; returns the alert for the user
+    if gateway == 'cryptocloud':
+        logger.error(f"Error checking payment status: {error}")
+        return "Error checking payment status"
+    if gateway == 'cryptomus':
+        admin_notifier.error("Cryptomus status check", error, text=f"Payment status check error: {str(error)}")
+    else:
+        admin_notifier.error("Oxapay status check", error, text=f"Oxapay status check error: {str(error)}")
+    return "Error checking payment status. Please try again."
+
+def run_status_check(call, client, request, result):
     try:
-        invoice_uuid = call.data.split("_")[1]
-        info_url = "https://api.cryptocloud.plus/v2/invoice/merchant/info"
-        headers = {
-            "Authorization": f"Token {CRYPTOCLOUD_TOKEN}"
-        }
+        payment_id, path, kwargs = request(call)
+        duration, alert = result(call, client.post(path, **kwargs))
+        if duration:
+            granted = grants.grant_premium(call.from_user.id, duration, f"{client.name}:{payment_id}")
+            if client.name == 'cryptocloud':
+                cryptocloud_reconciler.forget(payment_id)
+            alert = payment_checked(call, client.name, duration, granted)
+    except Exception as e:
+        alert = status_check_failed(client.name, e)
+    if alert:
+        bot.answer_callback_query(call.id, alert, show_alert=True)
 
-        check_data = {
-            "uuids": [invoice_uuid]
-        }
+@callback_router.prefix("check")
+def check_payment_status(call):
+    run_status_check(call, cryptocloud_client, cryptocloud_status_request, cryptocloud_status_result)
 
-        response = requests.post(info_url, headers=headers, json=check_data)
-
-        if response.status_code == 200:
-            data = response.json()
-            if data["status"] == "success":
-                for invoice in data["result"]:
-                    if invoice["status"] == "overpaid":
-                        bot.answer_callback_query(call.id, "Payment confirmed! Processing your premium activation...", show_alert=True)
-                        
-                        # Get duration from invoice amount
-                        duration = "1week" if invoice["amount"] == 1 else "1month"
-                        expiry = datetime.now() + timedelta(weeks=1 if duration == "1week" else 4)
-                        
-                        # Add user to appropriate collection
-                        payment_data = {
-                            'user_id': str(call.from_user.id),
-                            'expiry_date': expiry
-                        }
-                        
-                        if duration == "1week":
-                            one_week_prem.insert_one(payment_data)
-                        else:
-                            one_month_prem.insert_one(payment_data)
-
-                        # Update user's premium status in users collection
-                        users_collection.update_one(
-                            {'user_id': str(call.from_user.id)},
-                            {
-                                '$set': {
-                                    'is_premium': True,
-                                    'premium_start': datetime.now(),
-                                    'premium_duration': duration,
-                                    'expiry': expiry
-                                }
-                            },
-                            upsert=True
-                        )
-
-                        # Send confirmation to user
-                        bot.edit_message_text(
-                            chat_id=call.message.chat.id,
-                            message_id=call.message.message_id,
-                            text=f"✨ Your payment has been verified!\n\n▶️ Your {duration} premium subscription is now active.\n\n"
-                                "You can check it using /info command!\n🎉 Enjoy your premium features!"
-                        )
-                        return
-                    elif invoice["status"] == "created":
-                        bot.answer_callback_query(call.id, "Payment pending. Please complete the payment.", show_alert=True)
-                        return
-            
-        bot.answer_callback_query(call.id, "Please paid the payment first", show_alert=True)
+def notify_cryptocloud_paid(invoice):
+    # Called by the reconciler after it activated an invoice in the background
+    text = (
+        f"✨ Your payment has been verified!\n\n▶️ Your {invoice['duration']} premium subscription is now active.\n\n"
+        "You can check it using /info command!\n🎉 Enjoy your premium features!"
+    )
+    if invoice.get('chat_id') and invoice.get('message_id'):
+        outbox.edit_message_text(text=text, chat_id=invoice['chat_id'], message_id=invoice['message_id'])
+    else:
+        outbox.send_message(int(invoice['user_id']), text)
+
+cryptocloud_reconciler = CryptoCloudReconciler(
+    cryptocloud_client,
+    pending_invoices,
+    grants,
+    on_paid=notify_cryptocloud_paid,
+    batch_size=CRYPTOCLOUD_RECONCILE_BATCH
+)
 
-    except Exception as e:
-        logger.error(f"Error checking payment status: {e}")
-        bot.answer_callback_query(call.id, "Error checking payment status", show_alert=True)
+def payment_callback_url(gateway):
+    return f"{PAYMENT_CALLBACK_URL.rstrip('/')}/callbacks/{gateway}"
+
+def handle_payment_callback(gateway, payment_id, order_id):
+    # Verified push notification from Oxapay or Cryptomus saying the payment is settled
+    order = parse_order_id(order_id)
+    if order is None or not payment_id:
+        logger.warning(f"Ignoring {gateway} callback for unknown order {order_id}")
+        return
+
+    user_id, duration = order
+    if not grants.grant_premium(user_id, duration, f"{gateway}:{payment_id}"):
+        return
 
-def create_sign(payload, api_key):
-    json_data = json.dumps(payload)
-    base64_data = base64.b64encode(json_data.encode()).decode()
-    return hashlib.md5(f"{base64_data}{api_key}".encode()).hexdigest()
+    outbox.send_message(
+        int(user_id),
+        f"✨ Payment successful!\n\n▶️ Your {duration} premium is now active\n\nUse /info to check your status!"
+    )
+    admin_notifier.sale(gateway.capitalize(), detail=user_id)
+
+def handle_rejected_callback(gateway):
+    # The first rejection goes out at once, repeats (anyone can POST here) are counted in the digest
+    admin_notifier.notify(
+        'error', f"{gateway} callback signature",
+        f"⚠️ {gateway.capitalize()} payment callback rejected: bad signature",
+        leading=True
+    )
+
+payment_callbacks = callbacks.create_blueprint(
+    handle_payment_callback,
+    oxapay_merchant_key=OXAPAY_MERCHANT_KEY,
+    cryptomus_api_key=CRYPTOMUS_API_KEY,
+    on_rejected=handle_rejected_callback
+)
 
-@bot.callback_query_handler(func=lambda call: call.data == "cryptomus")
+@callback_router.route("cryptomus")
 def handle_cryptomus(call):
     try:
         # Create keyboard with duration options
-        keyboard = types.InlineKeyboardMarkup()
-        keyboard.row(
-            types.InlineKeyboardButton("1 Week ($1)", callback_data="durationmus_1week"),
-            types.InlineKeyboardButton("1 Month ($6)", callback_data="durationmus_1month")
-        )
+        keyboard = duration_keyboard("durationmus")
 
-        bot.edit_message_text(
+        outbox.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text="Please select your premium subscription duration:",
@@ -722,7 +1041,7 @@ def handle_cryptomus(call):
         logger.error(f"Error creating payment: {e}")
         bot.answer_callback_query(call.id, "Error creating payment. Please try again later.", show_alert=True)  
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("durationmus_"))
+@callback_router.prefix("durationmus")
 def handle_duration_selection_cryptomus(call):
     try:
         duration = call.data.split("_")[1]
@@ -732,12 +1051,14 @@ def handle_duration_selection_cryptomus(call):
         merchant_id = CRYPTOMUS_MERCHANT_ID
         api_key = CRYPTOMUS_API_KEY
 
-        order_id = str(uuid.uuid4())
+        order_id = make_order_id(call.from_user.id, duration)
         payment_data = {
             "amount": str(amount),
             "currency": "USD",
             "order_id": order_id
         }
+        if PAYMENT_CALLBACK_URL:
+            payment_data["url_callback"] = payment_callback_url('cryptomus')
 
         headers = {
             'merchant': merchant_id,
@@ -745,8 +1066,8 @@ def handle_duration_selection_cryptomus(call):
             'Content-Type': 'application/json'
         }
 
-        response = requests.post(
-            'https://api.cryptomus.com/v1/payment',
+        response = cryptomus_client.post(
+            '/v1/payment',
             headers=headers,
             json=payment_data
         )
@@ -758,112 +1079,37 @@ def handle_duration_selection_cryptomus(call):
         if not payment_url or not payment_uuid:
             raise Exception("Failed to create payment")
 
-        # Create keyboard with payment URL and check status button
+        # Create keyboard with payment URL, plus a status button when Cryptomus can't call us back
         keyboard = types.InlineKeyboardMarkup(row_width=1)
-        keyboard.add(
-            types.InlineKeyboardButton("Pay Now", url=payment_url),
-            types.InlineKeyboardButton("Check Payment Status", callback_data=f"checkmus_{payment_uuid}_{duration}")
-        )
+        keyboard.add(types.InlineKeyboardButton("Pay Now", url=payment_url))
+        text = f"Please complete your payment of ${amount} USD\nPayment will expire in 1 hours"
+        if PAYMENT_CALLBACK_URL:
+            text += "\n\nYour premium will be activated automatically once the payment is confirmed."
+        else:
+            keyboard.add(types.InlineKeyboardButton("Check Payment Status", callback_data=f"checkmus_{payment_uuid}_{duration}"))
 
-        bot.edit_message_text(
+        outbox.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
-            text=f"Please complete your payment of ${amount} USD\nPayment will expire in 1 hours",
+            text=text,
             reply_markup=keyboard
         )
 
     except Exception as e:
         bot.answer_callback_query(call.id, "Error creating payment. Please try again.")
-        bot.send_message(ADMIN_CHAT_ID, f"Payment creation error: {str(e)}")
+        admin_notifier.error("Cryptomus payment creation", e, text=f"Payment creation error: {str(e)}")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("checkmus_"))
-def check_payment_status(call):
-    try:
-        _, payment_uuid, duration = call.data.split("_")
-        
-        merchant_id = CRYPTOMUS_MERCHANT_ID
-        api_key = CRYPTOMUS_API_KEY
+@callback_router.prefix("checkmus")
+def check_cryptomus_status(call):
+    run_status_check(call, cryptomus_client, cryptomus_status_request, cryptomus_status_result)
 
-        payment_data = {
-            "uuid": payment_uuid
-        }
-
-        headers = {
-            'merchant': merchant_id,
-            'sign': create_sign(payment_data, api_key),
-            'Content-Type': 'application/json'
-        }
-
-        response = requests.post(
-            'https://api.cryptomus.com/v1/payment/info',
-            headers=headers,
-            json=payment_data
-        )
-
-        result = response.json().get('result', {})
-        payment_status = result.get('payment_status')
-
-        if payment_status == 'paid':
-            # Calculate expiry date
-            expiry = datetime.now() + timedelta(weeks=1 if duration == "1week" else 4)
-            
-            # Store payment data
-            payment_data = {
-                'user_id': str(call.from_user.id),
-                'expiry_date': expiry,
-            }
-            if duration == "1week":
-                one_week_prem.insert_one(payment_data)
-            else:  
-                one_month_prem.insert_one(payment_data)
-
-            # Update user's premium status
-            users_collection.update_one(
-                {'user_id': str(call.from_user.id)},
-                {
-                    '$set': {
-                        'is_premium': True,
-                        'premium_start': datetime.now(),
-                        'premium_duration': duration,
-                        'expiry': expiry
-                    }
-                },
-                upsert=True
-            )
-
-            bot.edit_message_text(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                text=f"✨ Payment successful!\n\n▶️ Your {duration} premium is now active\n\nUse /info to check your status!",
-                reply_markup=None
-            )
-
-            bot.send_message(
-                ADMIN_CHAT_ID,
-                f"New premium user via Cryptomus: {call.from_user.username} ({call.from_user.id})"
-            )
-        else:
-            bot.answer_callback_query(
-                call.id,
-                f"Payment status: {payment_status}. Please complete payment.",
-                show_alert=True
-            )
-
-    except Exception as e:
-        bot.answer_callback_query(call.id, "Error checking payment status. Please try again.")
-        bot.send_message(ADMIN_CHAT_ID, f"Payment status check error: {str(e)}")
-
-@bot.callback_query_handler(func=lambda call: call.data == "oxapay")
+@callback_router.route("oxapay")
 def handle_oxapay(call):
     try:
         # Create keyboard with duration options
-        keyboard = types.InlineKeyboardMarkup()
-        keyboard.row(
-            types.InlineKeyboardButton("1 Week ($1)", callback_data="durationoxa_1week"),
-            types.InlineKeyboardButton("1 Month ($6)", callback_data="durationoxa_1month")
-        )
+        keyboard = duration_keyboard("durationoxa")
 
-        bot.edit_message_text(
+        outbox.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text="Please select your premium subscription duration:",
@@ -873,15 +1119,14 @@ def handle_oxapay(call):
         logger.error(f"Error creating payment: {e}")
         bot.answer_callback_query(call.id, "Error creating payment. Please try again later.", show_alert=True)  
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("durationoxa_"))
+@callback_router.prefix("durationoxa")
 def handle_duration_selection_oxapay(call):
     try:
         duration = call.data.split("_")[1]
         amount = 1 if duration == "1week" else 6
         
         # Create payment request
-        url = 'https://api.oxapay.com/merchants/request'
-        order_id = str(uuid.uuid4())
+        order_id = make_order_id(call.from_user.id, duration)
         
         data = {
             'merchant': OXAPAY_MERCHANT_KEY,
@@ -890,30 +1135,32 @@ def handle_duration_selection_oxapay(call):
             'lifeTime': 1440,
             'feePaidByPayer': 1,
             'underPaidCover': 0,
-            'callbackUrl': 'https://t.me/nekopaybot',
+            'callbackUrl': payment_callback_url('oxapay') if PAYMENT_CALLBACK_URL else 'https://t.me/nekopaybot',
             'returnUrl': 'https://t.me/nekopaybot',
             'description': f'Premium {duration}',
             'orderId': order_id,
         }
 
-        response = requests.post(url, data=json.dumps(data))
+        response = oxapay_client.post('/merchants/request', data=json.dumps(data))
         result = response.json()
 
         if result.get('result') == 100:  # Success
             payment_url = result.get('payLink')
             track_id = result.get('trackId')
             
-            # Create keyboard with payment URL and check status button
+            # Create keyboard with payment URL, plus a status button when Oxapay can't call us back
             keyboard = types.InlineKeyboardMarkup(row_width=1)
-            keyboard.add(
-                types.InlineKeyboardButton("Pay Now", url=payment_url),
-                types.InlineKeyboardButton("Check Payment Status", callback_data=f"checkoxa_{track_id}_{duration}")
-            )
+            keyboard.add(types.InlineKeyboardButton("Pay Now", url=payment_url))
+            text = f"Please complete your payment of ${amount} USD\nPayment will expire in 24 hours"
+            if PAYMENT_CALLBACK_URL:
+                text += "\n\nYour premium will be activated automatically once the payment is confirmed."
+            else:
+                keyboard.add(types.InlineKeyboardButton("Check Payment Status", callback_data=f"checkoxa_{track_id}_{duration}"))
 
-            bot.edit_message_text(
+            outbox.edit_message_text(
                 chat_id=call.message.chat.id,
                 message_id=call.message.message_id,
-                text=f"Please complete your payment of ${amount} USD\nPayment will expire in 24 hours",
+                text=text,
                 reply_markup=keyboard
             )
         else:
@@ -921,124 +1168,50 @@ def handle_duration_selection_oxapay(call):
 
     except Exception as e:
         bot.answer_callback_query(call.id, "Error creating payment. Please try again.")
-        bot.send_message(ADMIN_CHAT_ID, f"Oxapay payment creation error: {str(e)}")
+        admin_notifier.error("Oxapay payment creation", e, text=f"Oxapay payment creation error: {str(e)}")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("checkoxa_"))
+@callback_router.prefix("checkoxa")
 def check_oxapay_status(call):
-    try:
-        # Split the callback data correctly - only expecting 3 parts
-        _, track_id, duration = call.data.split("_")
-        
-        # Check payment status
-        url = 'https://api.oxapay.com/merchants/inquiry'
-        data = {
-            'merchant': OXAPAY_MERCHANT_KEY,
-            'trackId': track_id
-        }
+    run_status_check(call, oxapay_client, oxapay_status_request, oxapay_status_result)
 
-        response = requests.post(url, data=json.dumps(data))
-        result = response.json()
-
-        if result.get('status') == 'Paid':
-            # Calculate expiry date
-            expiry = datetime.now() + timedelta(weeks=1 if duration == "1week" else 4)
-            
-            # Store payment data
-            payment_data = {
-                'user_id': str(call.from_user.id),
-                'expiry_date': expiry,
-                'payment_track_id': track_id
-            }
-            if duration == "1week":
-                one_week_prem.insert_one(payment_data)
-            else:
-                one_month_prem.insert_one(payment_data)
-
-            # Update user's premium status
-            users_collection.update_one(
-                {'user_id': str(call.from_user.id)},
-                {
-                    '$set': {
-                        'is_premium': True,
-                        'premium_start': datetime.now(),
-                        'premium_duration': duration,
-                        'expiry': expiry
-                    }
-                },
-                upsert=True
-            )
-
-            bot.edit_message_text(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                text=f"✨ Payment successful!\n\n▶️ Your {duration} premium is now active\n\nUse /info to check your status!",
-                reply_markup=None
-            )
-
-            bot.send_message(
-                ADMIN_CHAT_ID,
-                f"New premium user via Oxapay: {call.from_user.username} ({call.from_user.id})"
-            )
-        else:
-            bot.answer_callback_query(
-                call.id,
-                f"Payment status: {result.get('status')}. Please complete payment.",
-                show_alert=True
-            )
-
-    except Exception as e:
-        bot.answer_callback_query(call.id, "Error checking payment status. Please try again.")
-        bot.send_message(ADMIN_CHAT_ID, f"Oxapay status check error: {str(e)}")
-
-@bot.callback_query_handler(func=lambda call: call.data == "kofi_payment")
+@callback_router.route("kofi_payment")
 def handle_kofi(call):
     try:
         keyboard = kofi()
-        text = """
-        How to pay with kofi?
-        
-        1. Select the duration you want to buy at here button
-        2. Click the button below go to purchase the payment 
-        3. After payment, you will directed to payment success page. Then, you should copy your payment sucess link
-        4. Back to bot and click the button below to send your payment link
-        5. Paste your payment link
-        6. Done! Your premium will be activated
-        
-        If you have a trouble with payment, please contact our support. use /start and select report problem
-        """
-        bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id, text=text, reply_markup=keyboard)
+        text = KOFI_GUIDE
+        outbox.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id, text=text, reply_markup=keyboard)
     except Exception as e:
-        bot.send_message(call.message.chat.id, "An error occurred. Please try again later.")
-        bot.send_message(ADMIN_CHAT_ID, f"Error in handle_kofi: {str(e)}")
+        outbox.send_message(call.message.chat.id, "An error occurred. Please try again later.")
+        admin_notifier.error("handle_kofi", e, text=f"Error in handle_kofi: {str(e)}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "send_payment_link")
+@callback_router.route("send_payment_link")
 def handle_send_payment_link(call):
     try:
         force_reply = types.ForceReply(selective=True)
-        msg = bot.send_message(
+        outbox.send_message(
             call.message.chat.id,
             "Please send your Ko-fi payment link:",
             reply_markup=force_reply
         )
-        bot.register_next_step_handler(msg, process_payment_link)
+        bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_payment_link)
     except Exception as e:
-        bot.send_message(call.message.chat.id, "An error occurred. Please try again later.")
-        bot.send_message(ADMIN_CHAT_ID, f"Error in handle_send_payment_link: {str(e)}")
+        outbox.send_message(call.message.chat.id, "An error occurred. Please try again later.")
+        admin_notifier.error("handle_send_payment_link", e, text=f"Error in handle_send_payment_link: {str(e)}")
 
 def process_payment_link(message):
     try:
         if not validators.url(message.text):
-            bot.reply_to(message, "Please send a valid URL.")
+            outbox.reply_to(message, "Please send a valid URL.")
             return
             
         if not "ko-fi.com" in message.text.lower():
-            bot.reply_to(message, "Please send a valid Ko-fi payment link.")
+            outbox.reply_to(message, "Please send a valid Ko-fi payment link.")
             return
         
         # Check if URL exists in transactions
-        transaction = transactionsCollection.find_one({"url": message.text})
+        transaction = kofi_store.find(message.text)
         if not transaction:
-            bot.reply_to(message, "Payment link not found in our records.")
+            outbox.reply_to(message, "Payment link not found in our records.")
             return
 
         duration = None
@@ -1047,38 +1220,15 @@ def process_payment_link(message):
         elif transaction.get('type') == '7108bcad50':
             duration = "1week"
         else:
-            bot.reply_to(message, "Invalid payment type.")
+            outbox.reply_to(message, "Invalid payment type.")
             return
         
-        if duration == "1week":
-            expiry = datetime.now() + timedelta(weeks=1) # 1 month
-        else:
-            expiry = datetime.now() + timedelta(weeks=4)
-        
-        payment_data = {
-            'user_id': str(message.from_user.id),
-            'expiry_date': expiry 
-        }
-
-        if duration == "1week":
-            one_week_prem.insert_one(payment_data)
-        else:
-            one_month_prem.insert_one(payment_data)
-
-        users_collection.update_one(
-            {'user_id': str(message.from_user.id)},
-            {
-                '$set': {
-                    'is_premium': True,
-                    'premium_start': datetime.now(),
-                    'premium_duration': duration,
-                    'expiry': expiry
-                }
-            },
-            upsert=True
-        )
+        # A Ko-fi link can only be redeemed once, whichever account sends it
+        if not grants.grant_premium(message.from_user.id, duration, f"kofi:{transaction['url']}"):
+            outbox.reply_to(message, "This payment link has already been used.")
+            return
 
-        bot.reply_to(
+        outbox.reply_to(
             message,
             f"✨ Thank you! Your payment has been verified!\n\n"
             f"▶️ Your {duration} premium subscription is now active\n\n"
@@ -1086,13 +1236,18 @@ def process_payment_link(message):
             "🎉 Enjoy your premium features!"
         )
 
-        bot.send_message(
-            ADMIN_CHAT_ID,
-            f"New premium user: {message.from_user.username} ({message.from_user.id})"
+        admin_notifier.sale(
+            "Ko-fi",
+            detail=f"{message.from_user.username} ({message.from_user.id})",
+            text=f"New premium user: {message.from_user.username} ({message.from_user.id})"
         )
     except Exception as e:
-        bot.reply_to(message, "An error occurred while processing your payment. Please contact support.")
-        bot.send_message(ADMIN_CHAT_ID, f"Error in process_payment_link for user {message.from_user.id}: {str(e)}")
+        outbox.reply_to(message, "An error occurred while processing your payment. Please contact support.")
+        admin_notifier.error(
+            "process_payment_link", e,
+            text=f"Error in process_payment_link for user {message.from_user.id}: {str(e)}",
+            urgent=True
+        )
 
 @bot.message_handler(commands=['info'])
 def user_info(message):
@@ -1101,12 +1256,11 @@ def user_info(message):
         user = message.from_user
         dc = user.id or "Unknown"
         is_premium = check_user_id(str(user.id))
-        is_premium = check_user_id(str(user.id))
         premium_status = "Premium User" if is_premium else "Free User"
     
         # Calculate remaining premium duration
         if is_premium:
-            user_data = users_collection.find_one({'user_id': str(user.id)})
+            user_data = get_premium_state(user.id)
             if user_data:
                 expiry_date = user_data.get('expiry')
                 if expiry_date:
@@ -1126,8 +1280,7 @@ def user_info(message):
             premium_duration = "N/A"
 
         # Create keyboard markup
-        keyboard = types.InlineKeyboardMarkup()
-        keyboard.add(types.InlineKeyboardButton("Upgrade to Premium", callback_data="buy_premium"))
+        keyboard = upgrade_keyboard()
 
         # Build info text
         info_text = f"👤 First Name: {user.first_name}\n"
@@ -1138,7 +1291,7 @@ def user_info(message):
         info_text += f"⏳ Premium Duration: {premium_duration}"
 
         # Send response as text message
-        bot.send_message(
+        outbox.send_message(
             chat_id=message.chat.id,
             text=info_text,
             reply_markup=keyboard,
@@ -1147,111 +1300,134 @@ def user_info(message):
 
     except Exception as e:
         logger.error(f"Error in user info handler: {e}")
-        bot.reply_to(message, "Error getting user info. Please try again later.")
+        outbox.reply_to(message, "Error getting user info. Please try again later.")
 
 # Premium duration checker
+reminder_sender = BatchSender(batch_size=REMINDER_BATCH_SIZE, per_second=REMINDER_PER_SECOND)
+
+def send_premium_reminder(user):
+    user_id = user.get('user_id')
+    if not user_id:
+        raise ValueError("user has no user_id")
+    # user_id is stored as a string; the send queue keys chats by the int id
+    user_id = int(user_id)
+
+    # Create premium keyboard
+    keyboard = paynow("stars")
+
+    # Send alert message
+    alert = outbox.send_message(
+        chat_id=user_id,
+        text=f"⚠️ Premium Alert!\n\n"
+            f"Your premium subscription will expire in 2 days!\n"
+            f"Renew now to keep enjoying premium features:\n"
+            f"• Unlimited translations\n"
+            f"• Larger file size support\n"
+            f"• Priority support\n\n"
+            f"Don't miss out! 🌟",
+        reply_markup=keyboard
+    )
+
+    # Send alert in English and Indonesian
+    followup = outbox.send_message(
+        chat_id=user_id,
+        text="Alert: Your premium will expire soon! Please renew to continue enjoying premium features"
+    )
+    return [alert, followup]
+
 def check_premium_duration():
     try:
-        # Get all premium users
-        premium_users = users_collection.find({})
         current_time = datetime.now()
-        
-        for user in premium_users:
-            user_id = user.get('user_id')
-            expiry = user.get('expiry')
-            
-            if expiry:
-                # Calculate remaining days
-                remaining_time = expiry - current_time
-                remaining_days = remaining_time.days
-                
-                # If 2 days remaining, send alert
-                if remaining_days == 2:
-                    try:
-                        # Create premium keyboard
-                        keyboard = paynow()
-                        
-                        # Send alert message
-                        bot.send_message(
-                            chat_id=user_id,
-                            text=f"⚠️ Premium Alert!\n\n"
-                                f"Your premium subscription will expire in 2 days!\n"
-                                f"Renew now to keep enjoying premium features:\n"
-                                f"• Unlimited translations\n"
-                                f"• Larger file size support\n"
-                                f"• Priority support\n\n"
-                                f"Don't miss out! 🌟",
-                            reply_markup=keyboard
-                        )
-                        
-                        # Send alert in English and Indonesian
-                        bot.send_message(
-                            chat_id=user_id,
-                            text="Alert: Your premium will expire soon! Please renew to continue enjoying premium features"
-                        )
-                        
-                    except Exception as e:
-                        logger.error(f"Error sending alert to user {user_id}: {e}")
-                        
+
+        # Only users with 2 days remaining. The job runs every 24 hours, so each
+        # user falls into exactly one window.
+        expiring_users = users_collection.find(
+            {'expiry': {'$gte': current_time + timedelta(days=2), '$lt': current_time + timedelta(days=3)}},
+            {'_id': 0, 'user_id': 1, 'expiry': 1}
+        ).batch_size(REMINDER_BATCH_SIZE)
+
+        result = reminder_sender.run(expiring_users, send_premium_reminder)
+        logger.info(f"Premium reminders: {result['sent']} sent, {result['skipped']} skipped")
+        return result
+
     except Exception as e:
         logger.error(f"Error checking premium duration: {e}")
 
+import atexit
 import time
 from apscheduler.schedulers.background import BackgroundScheduler
 
-# Initialize scheduler
+# Initialize scheduler. Every replica schedules the jobs, only the lease holder runs them.
 scheduler = BackgroundScheduler()
-scheduler.add_job(check_premium_duration, 'interval', hours=24)
+scheduler_lease = MongoLease(scheduler_leases, 'scheduler', ttl=SCHEDULER_LEASE_TTL)
+leader_jobs = LeaderJobs(scheduler, scheduler_lease, scheduler_runs)
+leader_jobs.add_job(check_premium_duration, 'interval', hours=24)
+leader_jobs.add_job(
+    expiry_sweeper.run, 'interval', seconds=EXPIRY_SWEEP_INTERVAL,
+    id='expiry_sweep', max_instances=1, coalesce=True
+)
+leader_jobs.add_job(
+    cryptocloud_reconciler.run, 'interval', seconds=CRYPTOCLOUD_RECONCILE_INTERVAL,
+    id='cryptocloud_reconcile', max_instances=1, coalesce=True
+)
+
+# Admin broadcasts. Whichever replica holds the broadcast lease sends; the others pick up
+# a broadcast left running by a dead replica once its lease expires.
+broadcaster = Broadcaster(
+    broadcasts_collection,
+    users_collection,
+    MongoLease(scheduler_leases, 'broadcast', ttl=120),
+    outbox,
+    ADMIN_CHAT_ID,
+    BatchSender(batch_size=BROADCAST_BATCH_SIZE, per_second=BROADCAST_PER_SECOND),
+    report_interval=BROADCAST_REPORT_INTERVAL
+)
+scheduler.add_job(broadcaster.resume, 'interval', seconds=60, id='broadcast_resume', max_instances=1, coalesce=True)
+
+scheduler_lease.acquire()
 scheduler.start()
+broadcaster.resume()
+# Hand the lease over straight away on a clean shutdown
+atexit.register(scheduler_lease.release)
+# Don't lose the notices still waiting for the next digest
+atexit.register(admin_notifier.stop)
 
 def create_conversation(user_id):
     try:
-        # Use /tmp directory for SQLite database
-        db_path = '/tmp/support_bot.db'
-        with sqlite3.connect(db_path) as conn:
-            c = conn.cursor()
-            c.execute('''INSERT INTO conversations (user_id, status, created_at) 
-                        VALUES (?, ?, ?)''', (user_id, 'active', datetime.now().isoformat()))
-            conversation_id = c.lastrowid
-            return conversation_id
+        return support_store.create_conversation(user_id)
     except Exception as e:
         logger.error(f"Error creating conversation: {e}")
         return None
 
-@bot.callback_query_handler(func=lambda call: call.data == "report_problem")
+@callback_router.route("report_problem")
 def handle_report_problem(call):
     try:
         # Check if the user already has an active conversation
         existing_conversation_id = get_active_conversation(call.message.chat.id)
         
         if existing_conversation_id:
-            bot.send_message(call.message.chat.id, "You already have an active conversation. Please wait for a response or use /close to end it.")
+            outbox.send_message(call.message.chat.id, "You already have an active conversation. Please wait for a response or use /close to end it.")
             return
         
         conversation_id = create_conversation(call.message.chat.id)
         
         if conversation_id:
-            bot.send_message(
+            outbox.send_message(
                 call.message.chat.id,
                 "Please describe your problem or suggestion. Your message will be sent to our admin team.\n"
                 "Use /close when you want to end the conversation."
             )
             bot.register_next_step_handler(call.message, process_report, conversation_id)
         else:
-            bot.send_message(call.message.chat.id, "Error starting conversation. Please try again.")
+            outbox.send_message(call.message.chat.id, "Error starting conversation. Please try again.")
     except Exception as e:
         logger.error(f"Error in report problem handler: {e}")
-        bot.send_message(call.message.chat.id, "Error processing your request. Please try again.")
+        outbox.send_message(call.message.chat.id, "Error processing your request. Please try again.")
 
 def store_message(conversation_id, from_user, message_text):
     try:
-        # Use /tmp directory for SQLite database
-        db_path = '/tmp/support_bot.db'
-        with sqlite3.connect(db_path) as conn:
-            c = conn.cursor()
-            c.execute('''INSERT INTO messages (conversation_id, from_user, message_text, timestamp)
-                        VALUES (?, ?, ?, ?)''', (conversation_id, from_user, message_text, datetime.now().isoformat()))
-            return True
+        support_store.store_message(conversation_id, from_user, message_text)
+        return True
     except Exception as e:
         logger.error(f"Error storing message: {e}")
         return False
@@ -1268,30 +1444,31 @@ def process_report(message, conversation_id):
                             f"Conversation ID: {conversation_id}\n" \
                             f"Message: {report_text}\n\n" \
                             f"Reply to this message to respond to the user."
-            bot.send_message(ADMIN_CHAT_ID, admin_message)
+            sent = outbox.send_message(ADMIN_CHAT_ID, admin_message)
+            # Once we know its message id, admin replies to it can be routed back to this conversation
+            sent.add_done_callback(lambda f, user_id=message.chat.id: map_admin_report(f, user_id, conversation_id))
             
-            bot.reply_to(
+            outbox.reply_to(
                 message,
                 "Your message has been sent to our admin team. We'll respond shortly.\n"
                 "You can continue sending messages here, or use /close to end the conversation."
             )
             bot.register_next_step_handler(message, process_report, conversation_id)
         else:
-            bot.reply_to(message, "Error saving your message. Please try again.")
+            outbox.reply_to(message, "Error saving your message. Please try again.")
     except Exception as e:
         logger.error(f"Error processing report: {e}")
-        bot.reply_to(message, "Error processing your message. Please try again.")
+        outbox.reply_to(message, "Error processing your message. Please try again.")
+
+def map_admin_report(future, user_id, conversation_id):
+    try:
+        support_store.map_admin_message(future.result().message_id, user_id, conversation_id)
+    except Exception as e:
+        logger.error(f"Error mapping admin report for conversation {conversation_id}: {e}")
 
 def get_active_conversation(user_id):
     try:
-        # Use /tmp directory for SQLite database
-        db_path = '/tmp/support_bot.db'
-        with sqlite3.connect(db_path) as conn:
-            c = conn.cursor()
-            c.execute('''SELECT id FROM conversations WHERE user_id = ? AND status = 'active'
-                         ORDER BY created_at DESC LIMIT 1''', (user_id,))
-            result = c.fetchone()
-            return result[0] if result else None
+        return support_store.get_active_conversation(user_id)
     except Exception as e:
         logger.error(f"Error getting active conversation: {e}")
         return None
@@ -1303,92 +1480,240 @@ def close_conversation(message):
         conversation_id = get_active_conversation(message.chat.id)
         
         if conversation_id:
-            # Use /tmp directory for SQLite database
-            db_path = '/tmp/support_bot.db'
-            with sqlite3.connect(db_path) as conn:
-                c = conn.cursor()
-                
-                # Update conversation status to 'closed'
-                c.execute('''UPDATE conversations 
-                             SET status = 'closed', closed_at = ? 
-                             WHERE id = ?''', 
-                          (datetime.now().isoformat(), conversation_id))
-                conn.commit()  # Commit changes immediately
-                
-                # After commit, fetch the updated status to ensure correctness
-                c.execute('''SELECT status FROM conversations WHERE id = ?''', (conversation_id,))
-                status = c.fetchone()
+            # Update conversation status to 'closed'
+            if support_store.close_conversation(conversation_id):
+                # Send confirmation to the user
+                outbox.send_message(
+                    message.chat.id,
+                    "Conversation closed. Thank you for contacting us! You can start a new conversation anytime."
+                )
                 
-                if status and status[0] == 'closed':
-                    # Send confirmation to the user
-                    bot.send_message(
-                        message.chat.id,
-                        "Conversation closed. Thank you for contacting us! You can start a new conversation anytime."
-                    )
-                    
-                    # Notify the admin that the conversation has been closed
-                    bot.send_message(
-                        ADMIN_CHAT_ID,
-                        f"Conversation {conversation_id} with User {message.chat.id} has been closed."
-                    )
-                else:
-                    bot.reply_to(message, "Error closing the conversation. Please try again.")
+                # Notify the admin that the conversation has been closed
+                admin_notifier.event(
+                    "Conversations closed",
+                    f"Conversation {conversation_id} with User {message.chat.id} has been closed."
+                )
+            else:
+                outbox.reply_to(message, "Error closing the conversation. Please try again.")
         else:
-            bot.reply_to(message, "No active conversation found.")
+            outbox.reply_to(message, "No active conversation found.")
     
     except Exception as e:
         logger.error(f"Error closing conversation: {e}")
-        bot.reply_to(message, "Error closing conversation. Please try again.")
+        outbox.reply_to(message, "Error closing conversation. Please try again.")
 
-@bot.message_handler(func=lambda message: message.chat.id == int(ADMIN_CHAT_ID) and message.reply_to_message is not None)
-def handle_admin_response(message):
+@bot.message_handler(commands=['broadcast'], func=lambda message: message.chat.id == ADMIN_CHAT_ID)
+def handle_broadcast(message):
+    # /broadcast <premium|all> <text>, /broadcast status, /broadcast cancel
     try:
-        # Extract conversation context from the original message
-        original_message = message.reply_to_message.text
-        conversation_lines = original_message.split('\n')
-        user_id = None
-        conversation_id = None
-        
-        # Parse the User ID and Conversation ID from the original message
-        for line in conversation_lines:
+        parts = message.text.split(None, 2)
+        command = parts[1].lower() if len(parts) > 1 else ''
+
+        if command == 'status':
+            outbox.reply_to(message, broadcaster.status_text())
+        elif command == 'cancel':
+            cancelled = broadcaster.cancel()
+            outbox.reply_to(message, "Broadcast cancelled." if cancelled else "No broadcast is running.")
+        elif command in AUDIENCES and len(parts) == 3:
+            doc = broadcaster.start(parts[2], audience=command)
+            outbox.reply_to(message, f"Broadcasting to {doc['total']} {command} users. Progress will be posted here.")
+        else:
+            outbox.reply_to(
+                message,
+                "Usage:\n/broadcast premium <text> - message current premium users\n"
+                "/broadcast all <text> - message every user we have\n"
+                "/broadcast status\n/broadcast cancel"
+            )
+    except RuntimeError as e:
+        outbox.reply_to(message, f"{e}. Use /broadcast status or /broadcast cancel.")
+    except Exception as e:
+        logger.error(f"Error starting broadcast: {e}")
+        outbox.reply_to(message, "Error starting broadcast. Please try again.")
+
+def parse_admin_report(text):
+    # Reports forwarded before message ids were mapped only carry the ids in their text
+    user_id = None
+    conversation_id = None
+    for line in (text or '').split('\n'):
+        try:
             if "User ID:" in line:
                 user_id = int(line.split(": ")[1])
             elif "Conversation ID:" in line:
                 conversation_id = int(line.split(": ")[1])
+        except (IndexError, ValueError):
+            continue
+    return user_id, conversation_id
+
+@bot.message_handler(func=lambda message: message.chat.id == int(ADMIN_CHAT_ID) and message.reply_to_message is not None)
+def handle_admin_response(message):
+    try:
+        # Reports are mapped by their message id in the admin chat
+        route = support_store.route_admin_reply(message.reply_to_message.message_id)
+        if route:
+            user_id, conversation_id = route
+        else:
+            user_id, conversation_id = parse_admin_report(message.reply_to_message.text)
         
         if user_id and conversation_id:
             # Check if conversation is still active
-            # Use /tmp directory for SQLite database
-            db_path = '/tmp/support_bot.db'
-            conn = sqlite3.connect(db_path)
-            c = conn.cursor()
-            
-            c.execute('''SELECT id FROM conversations
-                         WHERE id = ? AND status = 'active' ''', (conversation_id,))
-            if c.fetchone():
+            if support_store.is_active(conversation_id):
                 # Store admin's response
                 store_message(conversation_id, False, message.text)
                 
                 # Forward response to user
-                bot.send_message(
+                outbox.send_message(
                     user_id,
                     f"Admin response: {message.text}\n\n"
                     "You can continue sending messages or use /close to end the conversation."
                 )
                 
                 # Confirm to admin
-                bot.reply_to(message, "Response sent to user.")
+                outbox.reply_to(message, "Response sent to user.")
             else:
-                bot.reply_to(message, "This conversation has been closed.")
-            
-            conn.close()
+                outbox.reply_to(message, "This conversation has been closed.")
         else:
-            bot.reply_to(message, "Could not determine user ID or conversation ID from the message context.")
+            outbox.reply_to(message, "Could not determine user ID or conversation ID from the message context.")
     
     except Exception as e:
         logger.error(f"Error handling admin response: {e}")
-        bot.reply_to(message, "Error sending response. Please try again.")
+        outbox.reply_to(message, "Error sending response. Please try again.")
+
+# Asyncio runtime: the status checks move onto one event loop with their own async clients,
+# sharing the request builders, parsers and payment_checked with the threaded handlers
+if RUNTIME == 'asyncio':
+    import async_runtime
+
+    runtime = async_runtime.AsyncRuntime(max_tasks=ASYNC_MAX_TASKS)
+    async_db = async_runtime.create_mongo_client(
+        runtime, MONGO_URL, event_listeners=[metrics.MongoCommandListener(mongo_ops)] if METRICS_ENABLED else []
+    )['redeem_db']
+    async_grants = async_runtime.AsyncGrantService(
+        async_db['users'], async_db['1week_prem'], async_db['1month_prem'], async_db['payments'], cache=premium_cache
+    )
+    async_bot = async_runtime.create_bot(runtime, BOT_TOKEN)
+    async_cryptocloud_client = async_runtime.AsyncGatewayClient(
+        'cryptocloud',
+        CRYPTOCLOUD_API_URL,
+        pool_size=int(os.getenv('CRYPTOCLOUD_POOL_SIZE', GATEWAY_POOL_SIZE)),
+        connect_timeout=GATEWAY_CONNECT_TIMEOUT,
+        read_timeout=GATEWAY_READ_TIMEOUT,
+        headers={"Authorization": f"Token {CRYPTOCLOUD_TOKEN}"}
+    )
+    async_cryptomus_client = async_runtime.AsyncGatewayClient(
+        'cryptomus',
+        CRYPTOMUS_API_URL,
+        pool_size=int(os.getenv('CRYPTOMUS_POOL_SIZE', GATEWAY_POOL_SIZE)),
+        connect_timeout=GATEWAY_CONNECT_TIMEOUT,
+        read_timeout=GATEWAY_READ_TIMEOUT
+    )
+    async_oxapay_client = async_runtime.AsyncGatewayClient(
+        'oxapay',
+        OXAPAY_API_URL,
+        pool_size=int(os.getenv('OXAPAY_POOL_SIZE', GATEWAY_POOL_SIZE)),
+        connect_timeout=GATEWAY_CONNECT_TIMEOUT,
+        read_timeout=GATEWAY_READ_TIMEOUT
+    )
+    for async_client in (async_cryptocloud_client, async_cryptomus_client, async_oxapay_client):
+        runtime.on_stop(async_client.close)
+
+    async_reconciler = async_runtime.AsyncCryptoCloudReconciler(
+        async_cryptocloud_client, async_db['pending_invoices'], async_grants
+    )
+
+    async def run_status_check_async(call, client, request, result):
+        # run_status_check with the provider, MongoDB and Telegram awaited
+        try:
+            payment_id, path, kwargs = request(call)
+            duration, alert = result(call, await client.post(path, **kwargs))
+            if duration:
+                granted = await async_grants.grant_premium(call.from_user.id, duration, f"{client.name}:{payment_id}")
+                if client.name == 'cryptocloud':
+                    await async_reconciler.forget(payment_id)
+                alert = payment_checked(call, client.name, duration, granted)
+        except Exception as e:
+            alert = status_check_failed(client.name, e)
+        if alert:
+            await async_bot.answer_callback_query(call.id, alert, show_alert=True)
+
+    for action, client, request, result in (
+        ('check', async_cryptocloud_client, cryptocloud_status_request, cryptocloud_status_result),
+        ('checkmus', async_cryptomus_client, cryptomus_status_request, cryptomus_status_result),
+        ('checkoxa', async_oxapay_client, oxapay_status_request, oxapay_status_result)
+    ):
+        handler = functools.partial(run_status_check_async, client=client, request=request, result=result)
+        handler.__name__ = f"{callback_router.prefixes[action].__name__}_async"
+        # Checks of one chat still run in the order its update worker handed them over
+        callback_router.prefixes[action] = runtime.handler(handler, key=lambda call: call.message.chat.id)
+    atexit.register(runtime.stop)
+
+# Callbacks that may be stored as next step handlers
+next_step_backend.allow(process_payment_screenshot, process_payment_link, process_report)
+
+# Instrument everything once all handlers are registered
+if METRICS_ENABLED:
+    metrics.instrument_bot(bot, handler_ops, router=callback_router)
+    metrics.instrument_telegram(telegram_ops)
+    for gateway_client in (cryptocloud_client, cryptomus_client, oxapay_client):
+        metrics.instrument_gateway(gateway_client, gateway_ops)
+    if RUNTIME == 'asyncio':
+        for gateway_client in (async_cryptocloud_client, async_cryptomus_client, async_oxapay_client):
+            metrics.instrument_gateway(gateway_client, gateway_ops)
+        metrics_registry.gauge_function('async_tasks_in_flight', "Coroutines running or waiting on the asyncio runtime",
+                                        lambda: runtime.stats['in_flight'])
+    metrics.instrument_methods(support_store, sqlite_ops, (
+        'create_conversation', 'store_message', 'get_active_conversation', 'is_active', 'close_conversation',
+        'map_admin_message', 'route_admin_reply'
+    ))
+    metrics_registry.gauge_function('update_queue_depth', "Updates waiting for a worker",
+                                    lambda: update_executor.stats()['depth'])
+    metrics_registry.gauge_function('send_queue_depth', "Outgoing Telegram calls waiting to be sent",
+                                    lambda: outbox.stats()['depth'])
+
+http_blueprints = [payment_callbacks, kofi_webhook.create_blueprint(kofi_store, KOFI_VERIFICATION_TOKEN)]
+if METRICS_ENABLED:
+    http_blueprints.append(metrics.create_blueprint(metrics_registry))
 
 if __name__ == '__main__':
-    bot.infinity_polling()
+    parser = argparse.ArgumentParser(description="NekoPay Telegram bot")
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default=BOT_MODE,
+                        help="how to receive updates from Telegram (default: BOT_MODE or polling)")
+    args = parser.parse_args()
+
+    update_recorder = None
+    if RECORD_UPDATES_PATH:
+        update_recorder = UpdateRecorder(
+            RECORD_UPDATES_PATH, max_bytes=RECORD_MAX_BYTES, backups=RECORD_BACKUPS, redact_text=RECORD_REDACT
+        )
+        logger.info(f"Recording updates to {RECORD_UPDATES_PATH}")
+
+    if args.mode == 'webhook':
+        webhook.run_webhook(
+            bot,
+            WEBHOOK_URL,
+            update_executor,
+            host=WEBHOOK_HOST,
+            port=WEBHOOK_PORT,
+            secret_token=WEBHOOK_SECRET,
+            path=WEBHOOK_PATH,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            blueprints=http_blueprints,
+            recorder=update_recorder,
+            threads=WEBHOOK_THREADS
+        )
+    else:
+        # Payment callbacks, the Ko-fi webhook and metrics still need an HTTP endpoint while polling
+        if PAYMENT_CALLBACK_URL or KOFI_VERIFICATION_TOKEN or METRICS_ENABLED:
+            webhook.serve_in_background(
+                webhook.create_app(blueprints=http_blueprints),
+                host=WEBHOOK_HOST,
+                port=WEBHOOK_PORT,
+                threads=WEBHOOK_THREADS
+            )
+
+        if update_recorder:
+            update_recorder.record_polling()
+
+        # getUpdates is refused while a webhook is registered
+        bot.remove_webhook()
+        bot.infinity_polling()
 
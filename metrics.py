@@ -0,0 +1,269 @@
+import bisect
+import functools
+import inspect
+import logging
+import threading
+import time
+
+from flask import Blueprint, Response
+from pymongo import monitoring
+from telebot import apihelper
+
+logger = logging.getLogger(__name__)
+
+# Seconds. Covers a cached Mongo read up to a stalled payment provider.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _label_str(labelnames, labels, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = sorted(self.values.items())
+        return self.header() + [f"{self.name}{_label_str(self.labelnames, k)} {v}" for k, v in values]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self.values.get(labels)
+            if series is None:
+                # Per-bucket counts (last one is +Inf), sum
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self):
+        with self._lock:
+            values = sorted((k, (list(v[0]), v[1])) for k, v in self.values.items())
+        lines = self.header()
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = _label_str(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_str(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_label_str(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Operations:
+    """Latency histogram, error counter and in-flight gauge for one kind of operation.
+
+    ``track(*labels)`` times a block, and ``wrap(func, *labels)`` times every
+    call of a function. An exception counts as an error and is re-raised.
+    """
+
+    def __init__(self, registry, prefix, what, labelnames):
+        self.latency = registry.add(Histogram(f"{prefix}_duration_seconds", f"{what} latency", labelnames))
+        self.errors = registry.add(Counter(f"{prefix}_errors_total", f"{what} errors", labelnames))
+        self.in_flight = registry.add(Gauge(f"{prefix}_in_flight", f"{what} in progress", labelnames))
+
+    def track(self, *labels):
+        return _Tracked(self, labels)
+
+    def wrap(self, func, *labels):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Tracked(self, labels):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class _Tracked:
+    __slots__ = ('ops', 'labels', 'started')
+
+    def __init__(self, ops, labels):
+        self.ops = ops
+        self.labels = labels
+
+    def __enter__(self):
+        self.ops.in_flight.inc(self.labels)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.ops.latency.observe(self.labels, time.perf_counter() - self.started)
+        self.ops.in_flight.dec(self.labels)
+        if exc_type is not None:
+            self.ops.errors.inc(self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.callbacks = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def operations(self, prefix, what, labelnames):
+        return Operations(self, prefix, what, labelnames)
+
+    def gauge_function(self, name, help, func):
+        # A gauge read from ``func()`` at scrape time, e.g. a queue depth
+        self.callbacks.append((name, help, func))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for name, help, func in self.callbacks:
+            try:
+                value = func()
+            except Exception as e:
+                logger.error(f"Error reading metric {name}: {e}")
+                continue
+            lines.extend([f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {value}"])
+        return '\n'.join(lines) + '\n'
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Feed every pymongo command into ``ops``, labelled (command, collection)."""
+
+    def __init__(self, ops):
+        self.ops = ops
+        self._started = {}
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        labels = (event.command_name, target if isinstance(target, str) else '')
+        self._started[(event.connection_id, event.request_id)] = labels
+        self.ops.in_flight.inc(labels)
+
+    def _finish(self, event, failed):
+        labels = self._started.pop((event.connection_id, event.request_id), None)
+        if labels is None:
+            return
+        self.ops.in_flight.dec(labels)
+        self.ops.latency.observe(labels, event.duration_micros / 1e6)
+        if failed:
+            self.ops.errors.inc(labels)
+
+    def succeeded(self, event):
+        self._finish(event, False)
+
+    def failed(self, event):
+        self._finish(event, True)
+
+
+def instrument_bot(bot, ops, router=None):
+    """Time every registered telebot handler, labelled (kind, handler).
+
+    Routed callback handlers are wrapped individually as kind ``callback``;
+    the catch-all callback_query handler that dispatches them shows the total.
+    Next step handlers are timed as a whole under ``next_step``.
+    """
+    for attr, handlers in vars(bot).items():
+        if not attr.endswith('_handlers') or not isinstance(handlers, list):
+            continue
+        kind = attr[:-len('_handlers')]
+        for handler in handlers:
+            if isinstance(handler, dict) and 'function' in handler:
+                handler['function'] = ops.wrap(handler['function'], kind, handler['function'].__name__)
+
+    if router is not None:
+        for table in (router.exact, router.prefixes):
+            for key, handler in table.items():
+                table[key] = ops.wrap(handler, 'callback', handler.__name__)
+
+    bot._notify_next_handlers = ops.wrap(bot._notify_next_handlers, 'next_step', 'notify_next_handlers')
+
+
+def instrument_telegram(ops):
+    # Every Bot API request goes through apihelper._make_request, labelled (method)
+    make_request = apihelper._make_request
+
+    @functools.wraps(make_request)
+    def timed_request(token, method_name, *args, **kwargs):
+        with ops.track(method_name):
+            return make_request(token, method_name, *args, **kwargs)
+
+    apihelper._make_request = timed_request
+
+
+def instrument_gateway(client, ops):
+    # Time GatewayClient.post (or AsyncGatewayClient.post) labelled (gateway, path); 5xx responses count as errors
+    post = client.post
+
+    @functools.wraps(post)
+    def timed_post(path, **kwargs):
+        labels = (client.name, path)
+        with ops.track(*labels):
+            response = post(path, **kwargs)
+        if response.status_code >= 500:
+            ops.errors.inc(labels)
+        return response
+
+    @functools.wraps(post)
+    async def timed_async_post(path, **kwargs):
+        labels = (client.name, path)
+        with ops.track(*labels):
+            response = await post(path, **kwargs)
+        if response.status_code >= 500:
+            ops.errors.inc(labels)
+        return response
+
+    client.post = timed_async_post if inspect.iscoroutinefunction(post) else timed_post
+
+
+def instrument_methods(obj, ops, names):
+    # Time the named methods of one object, labelled (method)
+    for name in names:
+        setattr(obj, name, ops.wrap(getattr(obj, name), name))
+
+
+def create_blueprint(registry):
+    bp = Blueprint('metrics', __name__)
+
+    @bp.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    return bp
@@ -0,0 +1,141 @@
+import logging
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Telegram rejects longer messages
+MAX_MESSAGE_LENGTH = 4096
+
+CATEGORY_TITLES = {'sale': "Sales", 'error': "Errors", 'event': "Events"}
+
+
+def error_key(error):
+    # Group errors that only differ in ids, amounts or timestamps
+    return re.sub(r'\d+', 'N', str(error))[:120]
+
+
+class AdminNotifier:
+    """Coalesce admin-chat notifications into periodic digests.
+
+    Events are counted per (category, key) and sent as one message every
+    ``window`` seconds, with counts, amount totals and a few examples per
+    key. ``urgent`` events are sent at once. So is the first event of a
+    ``leading`` key in each window, which makes the first error of an outage
+    arrive immediately while the rest only add to the count. With
+    ``window=0`` every event is sent on its own, as before.
+    """
+
+    def __init__(self, send, window=300, samples=3, top=5):
+        self.send = send
+        self.window = window
+        self.samples = samples
+        self.top = top
+        self._lock = threading.Lock()
+        self._events = {}
+        self._window_start = time.time()
+        self._stop = threading.Event()
+        self.stats = {'events': 0, 'sent': 0}
+        if window > 0:
+            self._thread = threading.Thread(target=self._run, name='admin-digest', daemon=True)
+            self._thread.start()
+
+    def sale(self, source, detail=None, amount=None, text=None):
+        self.notify('sale', source, text or f"New premium user via {source}: {detail}",
+                    detail=detail, amount=amount)
+
+    def error(self, source, error, text=None, urgent=False):
+        self.notify('error', f"{source}: {error_key(error)}", text or f"{source} error: {error}",
+                    detail=str(error), urgent=urgent, leading=True)
+
+    def event(self, key, text):
+        self.notify('event', key, text, detail=text)
+
+    def notify(self, category, key, text, detail=None, amount=None, urgent=False, leading=False):
+        # ``text`` is what gets sent when the event goes out on its own
+        if self.window <= 0 or urgent:
+            self._send(text)
+            return
+
+        with self._lock:
+            self.stats['events'] += 1
+            entry = self._events.get((category, key))
+            first = entry is None
+            if first:
+                entry = self._events[(category, key)] = {'count': 0, 'sent': 0, 'amount': 0, 'samples': []}
+            entry['count'] += 1
+            if amount is not None:
+                entry['amount'] += amount
+            if detail and len(entry['samples']) < self.samples:
+                entry['samples'].append(str(detail))
+            if first and leading:
+                entry['sent'] += 1
+
+        if first and leading:
+            self._send(text)
+
+    def flush(self, timeout=None):
+        # Send the digest for the current window, if anything is left to report.
+        # With a timeout, wait that long for ``send`` to deliver it if it returned a future.
+        with self._lock:
+            events, self._events = self._events, {}
+            started, self._window_start = self._window_start, time.time()
+        if not any(entry['count'] > entry['sent'] for entry in events.values()):
+            return False
+        result = self._send(self.format_digest(events, time.time() - started))
+        if timeout is not None and hasattr(result, 'result'):
+            try:
+                result.result(timeout=timeout)
+            except Exception as e:
+                logger.error(f"Error delivering admin digest: {e}")
+        return True
+
+    def format_digest(self, events, seconds):
+        lines = [f"📊 Admin digest, last {max(1, round(seconds / 60))} min"]
+        for category in ('sale', 'error', 'event'):
+            entries = sorted(
+                ((key, entry) for (cat, key), entry in events.items() if cat == category),
+                key=lambda item: item[1]['count'], reverse=True
+            )
+            if not entries:
+                continue
+            total = sum(entry['count'] for _, entry in entries)
+            lines.append(f"\n{CATEGORY_TITLES[category]}: {total}")
+            for key, entry in entries[:self.top]:
+                line = f"• {key}: {entry['count']}"
+                if entry['amount']:
+                    line += f" (total {entry['amount']:g})"
+                if entry['sent']:
+                    line += f", first {entry['sent']} sent already"
+                if entry['samples'] and category != 'error':
+                    line += f" — {', '.join(entry['samples'])}"
+                lines.append(line)
+            if len(entries) > self.top:
+                lines.append(f"• … {len(entries) - self.top} more")
+
+        text = '\n'.join(lines)
+        if len(text) > MAX_MESSAGE_LENGTH:
+            text = text[:MAX_MESSAGE_LENGTH - 1] + '…'
+        return text
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self.window > 0:
+            self.flush(timeout=timeout)
+
+    def _send(self, text):
+        try:
+            result = self.send(text)
+            with self._lock:
+                self.stats['sent'] += 1
+            return result
+        except Exception as e:
+            logger.error(f"Error sending admin notification: {e}")
+
+    def _run(self):
+        while not self._stop.wait(self.window):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error sending admin digest: {e}")
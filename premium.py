@@ -0,0 +1,192 @@
+import logging
+from datetime import datetime, timedelta
+
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+DURATIONS = {
+    '1week': timedelta(weeks=1),
+    '1month': timedelta(weeks=4),
+}
+
+
+class GrantService:
+    """The one place premium gets granted.
+
+    Every gateway payment id is first inserted into ``payments``, keyed
+    ``_id = "<gateway>:<id>"``, with ``state: 'pending'``. That collection
+    never expires, so a replayed payment (double taps, a retried callback, the
+    same Ko-fi link pasted again, even after the user's premium lapsed and the
+    user was swept) fails the insert with a duplicate key error and is
+    reported as a no-op after one round-trip. Only then is premium set on the
+    user's document, and the entry is marked ``'applied'``.
+
+    An entry still pending ``resume_after`` after it was claimed belongs to a
+    grant that died between the two writes. The same user's next attempt
+    claims it again and finishes that grant instead of being turned away.
+    Entries without a state are treated as applied.
+
+    Fresh grants are also mirrored into the legacy 1week/1month collections
+    with an upsert on the same payment id, so that mirror is idempotent too.
+    """
+
+    def __init__(self, users, week_collection, month_collection, payments, cache=None,
+                 resume_after=timedelta(seconds=30)):
+        self.users = users
+        self.week_collection = week_collection
+        self.month_collection = month_collection
+        self.payments = payments
+        self.cache = cache
+        self.resume_after = resume_after
+
+    def grant_premium(self, user_id, duration, payment_id):
+        # Returns True when premium was granted, False when the payment was already used
+        return run_steps(self.grant_steps(user_id, duration, payment_id))
+
+    def grant_steps(self, user_id, duration, payment_id):
+        # The grant as a generator of database calls: ledger entry, users write, mirror.
+        # Each yield hands a zero-argument call to a driver (run_steps here, an awaiting one
+        # for async collections), which sends its result back or throws its error in here.
+        user_id = str(user_id)
+        try:
+            yield lambda: self.payments.insert_one(self.ledger_entry(user_id, duration, payment_id))
+        except DuplicateKeyError:
+            entry = yield lambda: self.payments.find_one_and_update(*self.resume_claim(user_id, payment_id))
+            if entry is None:
+                logger.info(f"Ignoring duplicate grant of {payment_id} for user {user_id}")
+                return False
+            logger.warning(f"Finishing interrupted grant of {payment_id} for user {user_id}")
+            duration = entry['duration']
+
+        query, update, expiry = self.grant_update(user_id, duration)
+        try:
+            # On failure the entry stays pending, so a later attempt finishes the grant
+            yield lambda: self.users.update_one(query, update, upsert=True)
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate(user_id)
+        yield lambda: self.payments.update_one({'_id': payment_id}, {'$set': {'state': 'applied'}})
+
+        collection = self.mirror_collection(duration)
+        try:
+            yield lambda: collection.update_one(*self.mirror_update(user_id, payment_id, expiry), upsert=True)
+        except Exception as e:
+            # The users document is the source of truth, the mirror can lag
+            logger.error(f"Error mirroring grant {payment_id} to {collection.name}: {e}")
+
+        return True
+
+    def ledger_entry(self, user_id, duration, payment_id):
+        now = datetime.now()
+        return {
+            '_id': payment_id,
+            'user_id': user_id,
+            'duration': duration,
+            'state': 'pending',
+            'granted_at': now,
+            'claimed_at': now
+        }
+
+    def resume_claim(self, user_id, payment_id):
+        # (filter, update) that takes over this user's pending entry once its last claim is stale
+        now = datetime.now()
+        query = {
+            '_id': payment_id,
+            'user_id': user_id,
+            'state': 'pending',
+            'claimed_at': {'$lt': now - self.resume_after}
+        }
+        return query, {'$set': {'claimed_at': now}}
+
+    def grant_update(self, user_id, duration):
+        # (filter, update, expiry) of the users write for a grant
+        now = datetime.now()
+        expiry = now + DURATIONS[duration]
+        query = {'user_id': user_id}
+        update = {
+            '$set': {
+                'is_premium': True,
+                'premium_start': now,
+                'premium_duration': duration,
+                'expiry': expiry
+            }
+        }
+        return query, update, expiry
+
+    def mirror_collection(self, duration):
+        return self.week_collection if duration == '1week' else self.month_collection
+
+    def mirror_update(self, user_id, payment_id, expiry):
+        return {'payment_id': payment_id}, {'$setOnInsert': {'user_id': user_id, 'expiry_date': expiry}}
+
+
+def run_steps(steps):
+    # Drive a step generator such as GrantService.grant_steps, returns its return value
+    result, error = None, None
+    while True:
+        try:
+            call = steps.throw(error) if error is not None else steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = call(), None
+        except Exception as e:
+            result, error = None, e
+
+
+class ExpirySweeper:
+    """Remove expired premium users in the background.
+
+    Each run pages through users whose ``expiry`` has passed, oldest first on
+    the ``expiry`` index, ``batch_size`` at a time. Each page is deleted with
+    one ``delete_many`` that repeats the ``expiry`` condition, so a user who
+    was granted premium again between the read and the delete is kept. Their
+    legacy 1week/1month rows that have expired or carry no ``expiry_date`` go
+    the same way (the TTL indexes clear the dated ones eventually anyway).
+    Lifetime premium (``expiry`` of None) is never matched. Used payment ids
+    live in GrantService's ``payments`` ledger, which is never swept, so a
+    swept user can not redeem an old payment again.
+    """
+
+    def __init__(self, users, week_collection, month_collection, cache=None, batch_size=1000, max_batches=100):
+        self.users = users
+        self.week_collection = week_collection
+        self.month_collection = month_collection
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+
+    def run(self):
+        now = datetime.now()
+        counts = {'users': 0, 'week': 0, 'month': 0, 'batches': 0}
+
+        while counts['batches'] < self.max_batches:
+            expired = [
+                doc['user_id'] for doc in self.users.find(
+                    {'expiry': {'$lt': now}}, {'_id': 0, 'user_id': 1}
+                ).sort('expiry', 1).limit(self.batch_size)
+            ]
+            if not expired:
+                break
+            counts['batches'] += 1
+            counts['users'] += self.users.delete_many(
+                {'user_id': {'$in': expired}, 'expiry': {'$lt': now}}
+            ).deleted_count
+
+            legacy = {
+                'user_id': {'$in': expired},
+                '$or': [{'expiry_date': {'$lt': now}}, {'expiry_date': {'$exists': False}}]
+            }
+            counts['week'] += self.week_collection.delete_many(legacy).deleted_count
+            counts['month'] += self.month_collection.delete_many(legacy).deleted_count
+
+            if self.cache is not None:
+                for user_id in expired:
+                    self.cache.invalidate(user_id)
+            if len(expired) < self.batch_size:
+                break
+
+        logger.info(f"Expiry sweep removed {counts['users']} users, {counts['week']} weekly "
+                    f"and {counts['month']} monthly records in {counts['batches']} batches")
+        return counts
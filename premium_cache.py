@@ -0,0 +1,62 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class PremiumCache:
+    """In-process TTL/LRU cache of premium state keyed by user id.
+
+    Values are whatever the loader returns, including ``None`` for users that
+    have no premium record, so free users are answered from memory as well.
+    Grant paths must call ``invalidate`` after writing the users collection.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped on every invalidation so a load that raced with a write is not stored
+        self._epoch = 0
+
+    def get(self, user_id, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._data.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            epoch = self._epoch
+
+        value = loader()
+
+        with self._lock:
+            if epoch == self._epoch:
+                self._data[user_id] = (now + self.ttl, value)
+                self._data.move_to_end(user_id)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+        return value
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._epoch += 1
+            self._data.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses
+            }
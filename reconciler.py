@@ -0,0 +1,108 @@
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# CryptoCloud invoice states that mean the money arrived
+CRYPTOCLOUD_PAID_STATUSES = ('paid', 'overpaid')
+# States after which an invoice can never be paid
+CRYPTOCLOUD_DEAD_STATUSES = ('canceled',)
+
+
+class CryptoCloudReconciler:
+    """Activate paid CryptoCloud invoices without waiting for the user.
+
+    Invoices are recorded in ``pending`` when they are created. Each run
+    checks them against ``/v2/invoice/merchant/info`` in batches of
+    ``batch_size`` uuids per request, grants premium for the paid ones through
+    the same payment id the "Check Payment" button uses, and drops invoices
+    that are settled or dead. ``on_paid`` is called with the pending document
+    after a fresh grant so the caller can tell the user.
+    """
+
+    def __init__(self, client, pending, grants, on_paid=None, batch_size=100, max_invoices=5000):
+        self.client = client
+        self.pending = pending
+        self.grants = grants
+        self.on_paid = on_paid
+        self.batch_size = batch_size
+        self.max_invoices = max_invoices
+
+    def record(self, invoice_uuid, user_id, duration, amount, chat_id=None, message_id=None):
+        self.pending.update_one(
+            self.pending_filter(invoice_uuid),
+            {'$setOnInsert': {
+                'user_id': str(user_id),
+                'duration': duration,
+                'amount': amount,
+                'chat_id': chat_id,
+                'message_id': message_id,
+                'created_at': datetime.now()
+            }},
+            upsert=True
+        )
+
+    def forget(self, invoice_uuid):
+        self.pending.delete_one(self.pending_filter(invoice_uuid))
+
+    def pending_filter(self, invoice_uuid):
+        return {'uuid': invoice_uuid}
+
+    def run(self):
+        counts = {'checked': 0, 'activated': 0, 'dropped': 0}
+        invoices = self.pending.find({}, {'_id': 0}).sort('created_at', 1).limit(self.max_invoices)
+
+        batch = []
+        for invoice in invoices:
+            batch.append(invoice)
+            if len(batch) >= self.batch_size:
+                self._check_batch(batch, counts)
+                batch = []
+        if batch:
+            self._check_batch(batch, counts)
+
+        logger.info(
+            f"CryptoCloud reconcile: {counts['checked']} checked, "
+            f"{counts['activated']} activated, {counts['dropped']} dropped"
+        )
+        return counts
+
+    def _check_batch(self, batch, counts):
+        by_uuid = {invoice['uuid']: invoice for invoice in batch}
+        try:
+            response = self.client.post("/v2/invoice/merchant/info", json={"uuids": list(by_uuid)})
+            data = response.json()
+        except Exception as e:
+            logger.error(f"Error checking CryptoCloud invoices: {e}")
+            return
+
+        if response.status_code != 200 or data.get("status") != "success":
+            logger.error(f"CryptoCloud invoice check failed: {response.status_code} {data}")
+            return
+
+        counts['checked'] += len(batch)
+        settled = []
+        for result in data.get("result", []):
+            invoice = by_uuid.get(result.get("uuid"))
+            if invoice is None:
+                continue
+
+            if result.get("status") in CRYPTOCLOUD_PAID_STATUSES:
+                try:
+                    granted = self.grants.grant_premium(
+                        invoice['user_id'], invoice['duration'], f"cryptocloud:{invoice['uuid']}"
+                    )
+                except Exception as e:
+                    logger.error(f"Error activating CryptoCloud invoice {invoice['uuid']}: {e}")
+                    continue
+                settled.append(invoice['uuid'])
+                if granted:
+                    counts['activated'] += 1
+                    if self.on_paid:
+                        self.on_paid(invoice)
+            elif result.get("status") in CRYPTOCLOUD_DEAD_STATUSES:
+                settled.append(invoice['uuid'])
+                counts['dropped'] += 1
+
+        if settled:
+            self.pending.delete_many({'uuid': {'$in': settled}})
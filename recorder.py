@@ -0,0 +1,101 @@
+import glob
+import json
+import logging
+import logging.handlers
+import os
+import re
+import time
+
+from telebot import apihelper
+
+logger = logging.getLogger(__name__)
+
+# Free text users type, and who they are; callback data, ids and file ids are kept
+REDACTED_FIELDS = ('text', 'caption', 'first_name', 'last_name', 'username', 'phone_number', 'email')
+COMMAND = re.compile(r'^/\w+(@\w+)?')
+
+
+def redact(value):
+    # Replace the characters of REDACTED_FIELDS with 'x', keeping whitespace and length.
+    # A leading /command is kept, so replays still hit the same handlers and entity offsets stay valid.
+    if isinstance(value, dict):
+        return {
+            key: _mask(item) if key in REDACTED_FIELDS and isinstance(item, str) else redact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+
+def _mask(text):
+    match = COMMAND.match(text)
+    keep = match.end() if match else 0
+    return text[:keep] + re.sub(r'\S', 'x', text[keep:])
+
+
+class UpdateRecorder:
+    """Append raw incoming updates to a rotating JSON-lines log for bench/replay.py.
+
+    Each line is ``{"t": <unix time>, "u": <update>}`` in compact JSON. The
+    file rotates at ``max_bytes``, keeping ``backups`` old files next to it
+    as ``path.1``, ``path.2`` and so on, with ``path.1`` the most recent.
+    """
+
+    def __init__(self, path, max_bytes=50 * 1024 * 1024, backups=5, redact_text=True):
+        self.path = path
+        self.redact_text = redact_text
+        self._handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8'
+        )
+        self._handler.setFormatter(logging.Formatter('%(message)s'))
+        self._log = logging.getLogger(f'{__name__}.updates')
+        self._log.propagate = False
+        self._log.setLevel(logging.INFO)
+        self._log.addHandler(self._handler)
+
+    def record(self, update):
+        # ``update`` is the raw update dict as Telegram sent it
+        try:
+            if self.redact_text:
+                update = redact(update)
+            self._log.info(json.dumps({'t': round(time.time(), 3), 'u': update},
+                                      ensure_ascii=False, separators=(',', ':')))
+        except Exception as e:
+            logger.error(f"Error recording update: {e}")
+
+    def record_polling(self):
+        # Polling hands us parsed Update objects, so record the raw JSON getUpdates returned
+        get_updates = apihelper.get_updates
+
+        def recording_get_updates(*args, **kwargs):
+            updates = get_updates(*args, **kwargs)
+            for update in updates:
+                self.record(update)
+            return updates
+
+        apihelper.get_updates = recording_get_updates
+
+    def close(self):
+        self._log.removeHandler(self._handler)
+        self._handler.close()
+
+
+def read_log(path):
+    # Yield (timestamp, update) from a recorded log, oldest rotated file first
+    rotated = sorted(
+        (p for p in glob.glob(f'{glob.escape(path)}.*') if p.rsplit('.', 1)[-1].isdigit()),
+        key=lambda p: int(p.rsplit('.', 1)[-1]), reverse=True
+    )
+    for file_path in rotated + ([path] if os.path.exists(path) else []):
+        with open(file_path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash mid-write
+                    continue
+                yield entry['t'], entry['u']
@@ -0,0 +1,58 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CallbackRouter:
+    """Dispatch callback queries with dictionary lookups.
+
+    ``call.data`` is either an exact button id (``"buy_premium"``) or an
+    action prefix followed by ``_``-separated arguments (``"checkoxa_<id>_1week"``).
+    Exact ids are looked up first, then the part before the first ``_``, so
+    a tap costs at most two dict lookups however many buttons exist.
+    """
+
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = {}
+
+    def route(self, *data):
+        # Register a handler for exact callback data values
+        def decorator(handler):
+            for value in data:
+                self._add(self.exact, value, handler)
+            return handler
+        return decorator
+
+    def prefix(self, *actions):
+        # Register a handler for "<action>_<args...>" callback data
+        def decorator(handler):
+            for action in actions:
+                self._add(self.prefixes, action, handler)
+            return handler
+        return decorator
+
+    def _add(self, table, key, handler):
+        if key in table:
+            raise ValueError(f"Callback {key!r} is already routed to {table[key].__name__}")
+        table[key] = handler
+
+    def parse(self, data):
+        # Returns (action, args) for callback data
+        action, _, rest = (data or '').partition('_')
+        return action, rest.split('_') if rest else []
+
+    def resolve(self, data):
+        handler = self.exact.get(data)
+        if handler is not None:
+            return handler, data, []
+        action, args = self.parse(data)
+        return self.prefixes.get(action), action, args
+
+    def dispatch(self, call):
+        handler, action, args = self.resolve(call.data)
+        if handler is None:
+            logger.warning(f"No handler for callback data {call.data!r}")
+            return False
+        handler(call)
+        return True
@@ -0,0 +1,242 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import requests
+from telebot.apihelper import ApiTelegramException
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        # Seconds until a token is available, 0 if one can be taken right now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ('func', 'args', 'kwargs', 'future', 'attempts')
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.attempts = 0
+
+
+class SendQueue:
+    """Central outbound queue for Telegram API calls.
+
+    Calls are queued per chat and executed by a small pool of worker threads.
+    A global token bucket keeps the bot under Telegram's overall limit and a
+    per-chat bucket keeps each chat under its own limit (groups, which have
+    negative ids, get the lower group rate). Calls for the same chat run one
+    at a time and in order. A 429 pauses the chat for ``retry_after`` seconds,
+    network and 5xx errors are retried with exponential backoff, anything else
+    fails the call's future and is logged.
+    """
+
+    def __init__(self, bot, workers=4, global_rate=30, chat_rate=1, chat_burst=3, group_rate=20 / 60,
+                 max_retries=5, backoff=1.0, max_backoff=30.0):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._lock = threading.Condition()
+        self._chats = {}      # chat_id -> deque of pending jobs
+        self._buckets = {}    # chat_id -> TokenBucket
+        self._ready = []      # heap of (ready_at, seq, chat_id) for chats that can be picked up
+        self._seq = itertools.count()
+        self._pending = 0
+        self._in_flight = 0
+        self._stopped = False
+        self.counters = {'sent': 0, 'failed': 0, 'retried': 0, 'rate_limited': 0}
+
+        self._threads = [
+            threading.Thread(target=self._worker, name=f'send-queue-{i}', daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    # Convenience wrappers mirroring the TeleBot methods the handlers use
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.submit(chat_id, self.bot.send_message, chat_id, text, **kwargs)
+
+    def reply_to(self, message, text, **kwargs):
+        return self.submit(message.chat.id, self.bot.reply_to, message, text, **kwargs)
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        return self.submit(chat_id, self.bot.edit_message_text, text, chat_id, message_id, **kwargs)
+
+    def edit_message_reply_markup(self, chat_id, message_id, **kwargs):
+        return self.submit(chat_id, self.bot.edit_message_reply_markup, chat_id, message_id, **kwargs)
+
+    def forward_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        return self.submit(chat_id, self.bot.forward_message, chat_id, from_chat_id, message_id, **kwargs)
+
+    def submit(self, chat_id, func, *args, **kwargs):
+        job = _Job(func, args, kwargs)
+        with self._lock:
+            queue = self._chats.get(chat_id)
+            if queue is None:
+                queue = self._chats[chat_id] = deque()
+                heapq.heappush(self._ready, (time.monotonic(), next(self._seq), chat_id))
+            queue.append(job)
+            self._pending += 1
+            self._lock.notify()
+        return job.future
+
+    def stats(self):
+        with self._lock:
+            return {
+                'depth': self._pending,
+                'chats': len(self._chats),
+                'in_flight': self._in_flight,
+                **self.counters
+            }
+
+    def stop(self, timeout=None):
+        with self._lock:
+            self._stopped = True
+            self._lock.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _bucket_for(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) > 10000:
+                self._prune_buckets()
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self._buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    def _prune_buckets(self):
+        # Full buckets carry no state worth keeping
+        now = time.monotonic()
+        for chat_id in [c for c, b in self._buckets.items() if c not in self._chats and b.is_full(now)]:
+            del self._buckets[chat_id]
+
+    def _next_job(self):
+        # Returns (chat_id, job) once both rate limits allow it, or None when stopped
+        with self._lock:
+            while True:
+                if self._stopped:
+                    return None
+                if not self._ready:
+                    self._lock.wait()
+                    continue
+
+                now = time.monotonic()
+                ready_at, _, chat_id = self._ready[0]
+                if ready_at > now:
+                    self._lock.wait(ready_at - now)
+                    continue
+
+                heapq.heappop(self._ready)
+                chat_bucket = self._bucket_for(chat_id)
+                wait = max(chat_bucket.wait_time(now), self.global_bucket.wait_time(now))
+                if wait > 0:
+                    heapq.heappush(self._ready, (now + wait, next(self._seq), chat_id))
+                    continue
+
+                chat_bucket.take(now)
+                self.global_bucket.take(now)
+                job = self._chats[chat_id].popleft()
+                self._pending -= 1
+                self._in_flight += 1
+                return chat_id, job
+
+    def _finish(self, chat_id, retry_job=None, delay=0):
+        with self._lock:
+            self._in_flight -= 1
+            queue = self._chats[chat_id]
+            if retry_job is not None:
+                queue.appendleft(retry_job)
+                self._pending += 1
+            if queue:
+                heapq.heappush(self._ready, (time.monotonic() + delay, next(self._seq), chat_id))
+                self._lock.notify()
+            else:
+                del self._chats[chat_id]
+
+    def _worker(self):
+        while True:
+            item = self._next_job()
+            if item is None:
+                return
+            chat_id, job = item
+            job.attempts += 1
+            try:
+                result = job.func(*job.args, **job.kwargs)
+            except ApiTelegramException as e:
+                if e.error_code == 429 and job.attempts <= self.max_retries:
+                    retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                    self._count('rate_limited')
+                    logger.warning(f"Rate limited sending to {chat_id}, retrying in {retry_after}s")
+                    self._finish(chat_id, job, retry_after)
+                elif e.error_code >= 500 and job.attempts <= self.max_retries:
+                    self._retry(chat_id, job, e)
+                else:
+                    self._fail(chat_id, job, e)
+            except requests.RequestException as e:
+                if job.attempts <= self.max_retries:
+                    self._retry(chat_id, job, e)
+                else:
+                    self._fail(chat_id, job, e)
+            except Exception as e:
+                self._fail(chat_id, job, e)
+            else:
+                self._count('sent')
+                self._finish(chat_id)
+                job.future.set_result(result)
+
+    def _retry(self, chat_id, job, error):
+        delay = min(self.max_backoff, self.backoff * 2 ** (job.attempts - 1))
+        self._count('retried')
+        logger.warning(f"Error sending to {chat_id} (attempt {job.attempts}), retrying in {delay}s: {error}")
+        self._finish(chat_id, job, delay)
+
+    def _fail(self, chat_id, job, error):
+        self._count('failed')
+        logger.error(f"Error sending to {chat_id}: {error}")
+        self._finish(chat_id)
+        job.future.set_exception(error)
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
@@ -0,0 +1,66 @@
+import logging
+from datetime import datetime, timedelta
+
+from telebot import Handler
+from telebot.handler_backends import HandlerBackend
+
+logger = logging.getLogger(__name__)
+
+
+class MongoHandlerBackend(HandlerBackend):
+    """telebot next-step handler backend stored in a Mongo collection.
+
+    One document per chat holds the pending handlers. A callback is stored by
+    name, together with its arguments, and resolved against the functions
+    passed to ``allow``. Every replica can pick up a flow, and nothing executable
+    is unpickled from the database. ``get_handlers`` runs for every incoming
+    message, so it first does a plain ``find_one`` on ``_id``, and only when a
+    flow is pending does it ``find_one_and_delete`` it, so only one replica
+    consumes a reply. Documents carry ``expires_at``, which a TTL index uses
+    to evict flows nobody finished.
+    """
+
+    def __init__(self, collection, ttl=3600):
+        super(MongoHandlerBackend, self).__init__()
+        self.collection = collection
+        self.ttl = ttl
+        self.callbacks = {}
+
+    def allow(self, *callbacks):
+        for callback in callbacks:
+            self.callbacks[callback.__name__] = callback
+
+    def register_handler(self, handler_group_id, handler):
+        name = handler.callback.__name__
+        if self.callbacks.get(name) is not handler.callback:
+            raise ValueError(f"Next step callback {name} is not allowed, pass it to allow() first")
+
+        self.collection.update_one(
+            {'_id': handler_group_id},
+            {
+                '$push': {'handlers': {'callback': name, 'args': list(handler.args), 'kwargs': handler.kwargs}},
+                '$set': {'expires_at': datetime.now() + timedelta(seconds=self.ttl)}
+            },
+            upsert=True
+        )
+
+    def clear_handlers(self, handler_group_id):
+        self.collection.delete_one({'_id': handler_group_id})
+
+    def get_handlers(self, handler_group_id):
+        # Most messages have no pending flow: answer those with a read, not a write on the primary
+        if self.collection.find_one({'_id': handler_group_id}, {'_id': 1}) is None:
+            return None
+        doc = self.collection.find_one_and_delete({'_id': handler_group_id})
+        # The TTL monitor only runs once a minute, so check expiry ourselves too
+        if doc is None or doc.get('expires_at', datetime.max) < datetime.now():
+            return None
+
+        handlers = []
+        for saved in doc.get('handlers', []):
+            callback = self.callbacks.get(saved['callback'])
+            if callback is None:
+                logger.warning(f"Dropping next step handler {saved['callback']} for chat {handler_group_id}")
+                continue
+            handlers.append(Handler(callback, *saved.get('args', []), **saved.get('kwargs', {})))
+        return handlers or None
@@ -0,0 +1,121 @@
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+
+class SupportStore:
+    """SQLite store behind the support-conversation feature.
+
+    One long-lived connection is shared by all handler threads and serialized
+    with a lock, instead of connecting on every call. The database runs in WAL
+    mode with synchronous=NORMAL, so commits are cheap and readers never block
+    behind a writer.
+
+    Reports forwarded to the admin chat are mapped from their admin-side
+    message id to (user_id, conversation_id), both in a table and in an LRU
+    of the ``route_cache_size`` most recent ones, so an admin reply resolves
+    without parsing the replied-to text.
+    """
+
+    def __init__(self, path, route_cache_size=10000):
+        self.path = path
+        self._lock = threading.Lock()
+        self._routes = OrderedDict()
+        self.route_cache_size = route_cache_size
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA busy_timeout=10000')
+
+    def setup(self):
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute('''CREATE TABLE IF NOT EXISTS conversations (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            user_id INTEGER NOT NULL,
+                            status TEXT NOT NULL,
+                            created_at TIMESTAMP NOT NULL,
+                            closed_at TIMESTAMP)''')
+            c.execute('''CREATE TABLE IF NOT EXISTS messages (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            conversation_id INTEGER NOT NULL,
+                            from_user BOOLEAN NOT NULL,
+                            message_text TEXT NOT NULL,
+                            timestamp TIMESTAMP NOT NULL,
+                            FOREIGN KEY (conversation_id) REFERENCES conversations (id))''')
+            c.execute('''CREATE INDEX IF NOT EXISTS idx_conversations_user_status
+                         ON conversations (user_id, status, created_at)''')
+            c.execute('''CREATE INDEX IF NOT EXISTS idx_messages_conversation
+                         ON messages (conversation_id, timestamp)''')
+            c.execute('''CREATE TABLE IF NOT EXISTS admin_messages (
+                            admin_message_id INTEGER PRIMARY KEY,
+                            user_id INTEGER NOT NULL,
+                            conversation_id INTEGER NOT NULL,
+                            created_at TIMESTAMP NOT NULL)''')
+
+    def create_conversation(self, user_id):
+        with self._lock:
+            c = self.conn.execute('''INSERT INTO conversations (user_id, status, created_at)
+                                     VALUES (?, ?, ?)''', (user_id, 'active', datetime.now().isoformat()))
+            return c.lastrowid
+
+    def store_message(self, conversation_id, from_user, message_text):
+        with self._lock:
+            self.conn.execute('''INSERT INTO messages (conversation_id, from_user, message_text, timestamp)
+                                 VALUES (?, ?, ?, ?)''',
+                              (conversation_id, from_user, message_text, datetime.now().isoformat()))
+
+    def get_active_conversation(self, user_id):
+        with self._lock:
+            row = self.conn.execute('''SELECT id FROM conversations WHERE user_id = ? AND status = 'active'
+                                       ORDER BY created_at DESC LIMIT 1''', (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def is_active(self, conversation_id):
+        with self._lock:
+            row = self.conn.execute('''SELECT id FROM conversations
+                                       WHERE id = ? AND status = 'active' ''', (conversation_id,)).fetchone()
+        return row is not None
+
+    def close_conversation(self, conversation_id):
+        # Returns True if the conversation was active and is now closed
+        with self._lock:
+            c = self.conn.execute('''UPDATE conversations
+                                     SET status = 'closed', closed_at = ?
+                                     WHERE id = ? AND status = 'active' ''',
+                                  (datetime.now().isoformat(), conversation_id))
+            return c.rowcount == 1
+
+    def map_admin_message(self, admin_message_id, user_id, conversation_id):
+        with self._lock:
+            self.conn.execute('''INSERT OR REPLACE INTO admin_messages
+                                 (admin_message_id, user_id, conversation_id, created_at)
+                                 VALUES (?, ?, ?, ?)''',
+                              (admin_message_id, user_id, conversation_id, datetime.now().isoformat()))
+            self._remember_route(admin_message_id, (user_id, conversation_id))
+
+    def route_admin_reply(self, admin_message_id):
+        # Returns (user_id, conversation_id) for a report message in the admin chat, or None
+        with self._lock:
+            route = self._routes.get(admin_message_id)
+            if route is not None:
+                self._routes.move_to_end(admin_message_id)
+                return route
+            row = self.conn.execute('''SELECT user_id, conversation_id FROM admin_messages
+                                       WHERE admin_message_id = ?''', (admin_message_id,)).fetchone()
+            if row is None:
+                return None
+            route = (row[0], row[1])
+            self._remember_route(admin_message_id, route)
+            return route
+
+    def _remember_route(self, admin_message_id, route):
+        self._routes[admin_message_id] = route
+        self._routes.move_to_end(admin_message_id)
+        if len(self._routes) > self.route_cache_size:
+            self._routes.popitem(last=False)
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
@@ -0,0 +1,99 @@
+"""GrantService and ExpirySweeper against mongomock.
+
+    pip install -r requirements-dev.txt
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+try:
+    import mongomock
+except ImportError:
+    raise unittest.SkipTest("mongomock is not installed, see requirements-dev.txt")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from premium import ExpirySweeper, GrantService
+from premium_cache import PremiumCache
+
+
+class ExpirySweepTest(unittest.TestCase):
+    def setUp(self):
+        db = mongomock.MongoClient()['redeem_db']
+        self.users = db['users']
+        self.cache = PremiumCache()
+        self.grants = GrantService(db['users'], db['1week_prem'], db['1month_prem'], db['payments'], cache=self.cache)
+        self.sweeper = ExpirySweeper(db['users'], db['1week_prem'], db['1month_prem'], cache=self.cache)
+
+    def expire(self, user_id):
+        self.users.update_one({'user_id': user_id}, {'$set': {'expiry': datetime.now() - timedelta(minutes=1)}})
+
+    def test_payment_id_cannot_be_redeemed_after_sweep(self):
+        self.assertTrue(self.grants.grant_premium(1, '1week', 'kofi:https://ko-fi.com/s/abc'))
+        self.assertFalse(self.grants.grant_premium(1, '1week', 'kofi:https://ko-fi.com/s/abc'))
+
+        self.expire('1')
+        self.assertEqual(self.sweeper.run()['users'], 1)
+        self.assertIsNone(self.users.find_one({'user_id': '1'}))
+
+        self.assertFalse(self.grants.grant_premium(1, '1week', 'kofi:https://ko-fi.com/s/abc'))
+        self.assertFalse(self.grants.grant_premium(2, '1week', 'kofi:https://ko-fi.com/s/abc'))
+
+    def test_sweep_keeps_active_and_lifetime_users(self):
+        self.grants.grant_premium(1, '1week', 'oxapay:1')
+        self.grants.grant_premium(2, '1month', 'oxapay:2')
+        self.users.insert_one({'user_id': '3', 'expiry': None})
+        self.expire('1')
+
+        counts = self.sweeper.run()
+
+        self.assertEqual(counts['users'], 1)
+        self.assertEqual(sorted(user['user_id'] for user in self.users.find()), ['2', '3'])
+
+    def test_sweep_spares_a_user_granted_again(self):
+        self.grants.grant_premium(1, '1week', 'cryptomus:a')
+        self.expire('1')
+        self.grants.grant_premium(1, '1month', 'cryptomus:b')
+
+        self.assertEqual(self.sweeper.run()['users'], 0)
+        self.assertEqual(self.users.find_one({'user_id': '1'})['premium_duration'], '1month')
+
+
+class GrantLedgerTest(unittest.TestCase):
+    def setUp(self):
+        db = mongomock.MongoClient()['redeem_db']
+        self.users = db['users']
+        self.payments = db['payments']
+        self.grants = GrantService(db['users'], db['1week_prem'], db['1month_prem'], db['payments'])
+
+    def test_grant_marks_entry_applied(self):
+        self.assertTrue(self.grants.grant_premium(1, '1week', 'oxapay:1'))
+        self.assertEqual(self.payments.find_one({'_id': 'oxapay:1'})['state'], 'applied')
+
+    def test_failed_grant_is_finished_by_a_retry(self):
+        with mock.patch.object(self.users, 'update_one', side_effect=RuntimeError('connection reset')):
+            with self.assertRaises(RuntimeError):
+                self.grants.grant_premium(1, '1month', 'cryptomus:a')
+        self.assertEqual(self.payments.find_one({'_id': 'cryptomus:a'})['state'], 'pending')
+
+        # A retry right away could be racing the first attempt
+        self.assertFalse(self.grants.grant_premium(1, '1month', 'cryptomus:a'))
+
+        self.payments.update_one({'_id': 'cryptomus:a'}, {'$set': {'claimed_at': datetime.now() - timedelta(minutes=5)}})
+        self.assertFalse(self.grants.grant_premium(2, '1month', 'cryptomus:a'))
+        self.assertTrue(self.grants.grant_premium(1, '1week', 'cryptomus:a'))
+
+        self.assertEqual(self.users.find_one({'user_id': '1'})['premium_duration'], '1month')
+        self.assertEqual(self.payments.find_one({'_id': 'cryptomus:a'})['state'], 'applied')
+        self.assertFalse(self.grants.grant_premium(1, '1month', 'cryptomus:a'))
+
+    def test_entry_without_state_counts_as_applied(self):
+        self.payments.insert_one({'_id': 'stars:x', 'user_id': '1', 'duration': '1week', 'granted_at': datetime.min})
+        self.assertFalse(self.grants.grant_premium(1, '1week', 'stars:x'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import json
+import logging
+import signal
+import sys
+import threading
+
+import telebot
+from flask import Flask, request, abort
+from waitress.server import create_server
+
+logger = logging.getLogger(__name__)
+
+
+def create_app(executor=None, secret_token=None, path='/webhook', blueprints=(), recorder=None):
+    app = Flask(__name__)
+    for blueprint in blueprints:
+        app.register_blueprint(blueprint)
+
+    @app.route('/healthz', methods=['GET'])
+    def healthz():
+        return 'ok'
+
+    # Without an executor the app only serves the extra blueprints (polling mode)
+    if executor is None:
+        return app
+
+    @app.route(path, methods=['POST'])
+    def telegram_webhook():
+        # Telegram echoes the secret we registered in set_webhook
+        if secret_token and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret_token:
+            abort(403)
+
+        body = request.get_data(as_text=True)
+        update = telebot.types.Update.de_json(body)
+        if update is None:
+            abort(400)
+        if recorder is not None:
+            recorder.record(json.loads(body))
+
+        if not executor.submit(update, block=False):
+            # The chat's shard is full, Telegram will redeliver the update
+            return 'busy', 503
+        return ''
+
+    return app
+
+
+def serve_in_background(app, host='0.0.0.0', port=8080, threads=8):
+    # Used in polling mode so payment callbacks still have somewhere to land
+    server = create_server(app, host=host, port=port, threads=threads)
+    thread = threading.Thread(target=server.run, name='http-server', daemon=True)
+    thread.start()
+    logger.info(f"Serving HTTP endpoints on {host}:{port}")
+    return server
+
+
+def run_webhook(bot, url, executor, host='0.0.0.0', port=8080, secret_token=None, path='/webhook',
+                max_connections=40, blueprints=(), recorder=None, threads=8):
+    # Updates are queued on ``executor`` (anything with submit(update, block=False) -> bool).
+    # Served by waitress with ``threads`` request threads; SIGTERM closes the listener and exits
+    # normally, so atexit handlers (scheduler lease, admin digest) still run.
+    app = create_app(executor, secret_token=secret_token, path=path, blueprints=blueprints, recorder=recorder)
+
+    if url:
+        bot.remove_webhook()
+        bot.set_webhook(
+            url=url.rstrip('/') + path,
+            secret_token=secret_token,
+            max_connections=min(max_connections, 100)
+        )
+        logger.info(f"Webhook set to {url.rstrip('/') + path}")
+    else:
+        logger.warning("WEBHOOK_URL is not set, assuming the webhook is registered elsewhere")
+
+    server = create_server(app, host=host, port=port, threads=threads)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info(f"Serving webhook on {host}:{port} with {threads} threads")
+    # run() returns once SIGTERM/Ctrl+C stops the loop
+    try:
+        server.run()
+    finally:
+        server.close()